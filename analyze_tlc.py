@@ -8,20 +8,25 @@ Thin layer chromatography spot segmentation & quantification.
 
 # Need matplotlib for saving image
 import matplotlib
-import matplotlib.pyplot as plt
 
 # Import other Python libraries we use
 import argparse
+import atexit
+import os
+import sys
 from collections import defaultdict
 from sys import stdout
 from glob import glob
 from datetime import datetime
 import time
+import traceback
 import csv
 import multiprocessing
+import tempfile
 #from imageio import imread  # This causes come problems; using PIL instead
 import PIL
 import numpy as np
+from scipy import ndimage as ndi
 from scipy.spatial.distance import euclidean
 from skimage import dtype_limits
 from skimage.feature import (peak_local_max,
@@ -36,13 +41,6 @@ from skimage.io import imsave
 from skimage.segmentation import find_boundaries
 from skimage.util import invert
 
-#We use Tkinter for GUI
-import tkinter as tk
-from PIL import Image, ImageTk
-
-# Import image analysis library
-import appaloosa
-
 
 # Define and parse arguments; use custom MyFormatter to do both ArgumentDefault
 # and RawDescription Formatters via multiple inheritence, this is a trick to
@@ -54,7 +52,9 @@ class MyFormatter(argparse.ArgumentDefaultsHelpFormatter,
 parser = argparse.ArgumentParser(description=__doc__,
                                  formatter_class=MyFormatter,
                                 )
-image_filename_helpstring = "Image of TLC plate"
+image_filename_helpstring = ("Image of TLC plate. With --batch, a glob "
+                             "pattern or a directory of plate images."
+                            )
 parser.add_argument('image_filename',
                     help=image_filename_helpstring,
                    )
@@ -75,315 +75,332 @@ parser.add_argument('--zoom',
                     default=3,
                     help=zoom_helpstring,
                    )
-args = parser.parse_args()
-
-# Load plate image
-image = np.array(PIL.Image.open(args.image_filename))
-plate = appaloosa.Plate(image=image,
-                        #image=imread(args.image_filename),
-                        tag_in='original_image',
-                        source_filename=args.image_filename,
+batch_helpstring = ("Segment every plate matched by image_filename without "
+                    "the GUI, writing a segmented PNG and an intensities CSV "
+                    "per plate."
+                   )
+parser.add_argument('--batch',
+                    action='store_true',
+                    default=False,
+                    help=batch_helpstring,
+                   )
+workers_helpstring = ("Number of worker processes used in batch mode. "
+                      "Defaults to the number of CPUs."
+                     )
+parser.add_argument('--workers',
+                    type=int,
+                    default=None,
+                    help=workers_helpstring,
+                   )
+output_dir_helpstring = "Directory batch mode writes its outputs to."
+parser.add_argument('--output_dir',
+                    default='.',
+                    help=output_dir_helpstring,
+                   )
+cache_dir_helpstring = ("Directory for the on-disk cache of pipeline stage "
+                        "outputs, so reopening or re-running a plate only "
+                        "recomputes stages whose inputs or parameters "
+                        "changed. Caching is off if not given."
                        )
-if args.intermediate_images:
-    plate.display(tag_in='original_image',
-                  figsize=intermediate_images_figsize,
-                  output_filename="original_image.png",
-                 )
-
-# Segment the plates from the background
-plate.crop_to_plate(tag_in='original_image',
-                    tag_out='cropped_image',
-                    feature_out='crop_rotation',
-                    second_pass=False,
+parser.add_argument('--cache_dir',
+                    default=None,
+                    help=cache_dir_helpstring,
                    )
-if args.intermediate_images:
-    plate.display(tag_in='cropped_image',
-                  figsize=intermediate_images_figsize,
-                  output_filename="cropped_image.png",
-                 )
-
-# Trim the outermost pixels a bit to make sure no background remains around the
-# edges
-cropped_image = plate.image_stash['cropped_image']
-cropped_image_height, cropped_image_width = cropped_image.shape[:2]
-cropped_image_min_dimension = min(cropped_image_height, cropped_image_width)
-percent_crop = 0.03
-border = int(round(cropped_image_min_dimension * percent_crop))
-plate.crop_border(tag_in='cropped_image',
-                  tag_out='border_cropped_image',
-                  border=border,
-                 )
-if args.intermediate_images:
-    plate.display(tag_in='border_cropped_image',
-                  figsize=intermediate_images_figsize,
-                  output_filename="border_cropped_image.png",
-                 )
-
-# Rescale image to standard size
-# This is very important because the image morphology parameters we use for analysis are defined
-# in terms of pixels and therefore are specific to a (ballpark) resolution.
-cropped_image = plate.image_stash['border_cropped_image']
-cropped_height, cropped_width = cropped_image.shape[:2]
-largest_dimension = max(cropped_height, cropped_width)
-target_scale = 500
-scaling_factor = float(target_scale) / largest_dimension
-plate.rescale_image(tag_in='border_cropped_image',
-                    tag_out='rescaled_image',
-                    scaling_factor=scaling_factor,
+profile_helpstring = ("Record wall time, CPU time, peak memory and output "
+                      "sizes of every pipeline stage and write them to "
+                      "<basename>_profile.json and <basename>_profile.csv "
+                      "alongside the saved outputs."
+                     )
+parser.add_argument('--profile',
+                    action='store_true',
+                    default=False,
+                    help=profile_helpstring,
+                   )
+stash_budget_helpstring = ("Megabytes of intermediate images each plate keeps "
+                           "in memory; beyond this the least recently used "
+                           "are spilled to memory-mapped files. Unlimited if "
+                           "not given."
+                          )
+parser.add_argument('--stash_budget',
+                    type=float,
+                    default=None,
+                    help=stash_budget_helpstring,
+                   )
+spill_dir_helpstring = ("Directory for spilled intermediate images. Defaults "
+                        "to the system temporary directory."
+                       )
+parser.add_argument('--spill_dir',
+                    default=None,
+                    help=spill_dir_helpstring,
+                   )
+fast_crop_helpstring = ("Find the plate on a downsampled mask and crop, "
+                        "rotate and rescale it in a single warp. Much faster "
+                        "on large photographs, at the cost of a slightly "
+                        "softer analysis image."
+                       )
+parser.add_argument('--fast_crop',
+                    action='store_true',
+                    default=False,
+                    help=fast_crop_helpstring,
+                   )
+median_method_helpstring = ("Algorithm for the median background correction: "
+                            "'filter' (skimage.filters.median over a disk), "
+                            "'histogram' (exact median of 8-bit levels over "
+                            "the enclosing square, at a cost that does not "
+                            "grow with the radius) or 'approximate' (on a "
+                            "downsampled image). Defaults to 'filter'."
+                           )
+parser.add_argument('--median_method',
+                    choices=['filter', 'histogram', 'approximate'],
+                    default='filter',
+                    help=median_method_helpstring,
+                   )
+recompute_background_helpstring = ("Median filter the corrected image again "
+                                   "for the waterfall segmentation, as "
+                                   "earlier versions did, instead of "
+                                   "correcting the rescaled image by the "
+                                   "median background already computed for "
+                                   "the median correction. Twice the median "
+                                   "filtering, but reproduces their "
+                                   "segmentations."
+                                  )
+parser.add_argument('--recompute_background',
+                    action='store_true',
+                    default=False,
+                    help=recompute_background_helpstring,
                    )
-if args.intermediate_images:
-    plate.display(tag_in='rescaled_image',
-                  figsize=intermediate_images_figsize,
-                  output_filename="rescaled_image.png",
-                 )
-
 
-# Median correct the image to correct uneven intensity over the plate
-uncorrected_image = plate.image_stash['rescaled_image']
-corrected_image = appaloosa.Plate.median_correct_image(image=uncorrected_image,
-                                                       median_disk_radius=31,
-                                                      )
-plate.image_stash['corrected_rescaled_image'] = corrected_image
-if args.intermediate_images:
-    plate.display(tag_in='corrected_rescaled_image',
-                  figsize=intermediate_images_figsize,
-                  output_filename="corrected_rescaled_image.png",
-                 )
+# Batch mode never opens a window, so keep matplotlib off the GUI backends.
+# Decided from sys.argv, which batch workers started by spawn share with the
+# parent, as those import this module without running main()
+if '--batch' in sys.argv[1:]:
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 
-# Let's try segmenting the spots using the waterfall algorithm
-plate.waterfall_segmentation(tag_in='corrected_rescaled_image',
-                             feature_out='waterfall_basins',
-                             R_out='R_img',
-                             mg_out='mg_img',
-                             median_disk_radius=31,
-                             smoothing_sigma=2,
-                             threshold_opening_size=2,
-                             basin_open_close_size=5,
-                             skeleton_label=0,
-                             debug_output=False,
-                            )
-if args.intermediate_images:
-    plate.display(tag_in='corrected_rescaled_image',
-                  basins_feature='waterfall_basins',
-                  figsize=intermediate_images_figsize,
-                  output_filename="waterfall_basins.png",
-                 )
+# Import image analysis library
+import appaloosa
 
-# The largest item found is the background; we need to get rid of it
-plate.remove_most_frequent_label(basins_feature='waterfall_basins',
-                                 feature_out='filtered_waterfall_basins',
-                                 debug_output=False,
-                                )
 
-# Overlay finegrained watershed over waterfall segmentation
-plate.overlay_watershed(tag_in='corrected_rescaled_image',
-                        intensity_image_tag='corrected_rescaled_image',
-                        median_radius=None,
-                        filter_basins=True,
-                        waterfall_basins_feature='filtered_waterfall_basins',
-                        feature_out='overlaid_watershed_basins',
-                        min_localmax_dist=5,
-                        smoothing_sigma=1,
-                        min_area=10,
-                        min_intensity=0.1,
-                        rp_radius_factor=None,
-                        debug_output=False,
-                        basin_open_close_size=None,
-                       )
-if args.intermediate_images:
-    plate.display(tag_in='corrected_rescaled_image',
-                  basins_feature='overlaid_watershed_basins',
-                  figsize=intermediate_images_figsize,
-                  output_filename='overlaid_watershed_basins.png',
-                 )
+def segment_plate(image_filename,
+                  intermediate_images=False,
+                  intermediate_prefix='',
+                  cache_dir=None,
+                  profile=False,
+                  stash_budget=None,
+                  spill_dir=None,
+                  fast_crop=False,
+                  median_method='filter',
+                  reuse_background=True,
+                 ):
+    """
+    Define the crop -> border -> rescale -> median-correct -> waterfall ->
+    overlay_watershed -> measure pipeline on one plate image and return the
+    resulting appaloosa.Plate. Stages run lazily (see
+    appaloosa.Plate.define_stage), when their outputs are first read.
+    fast_crop replaces the first three stages with
+    appaloosa.Plate.fast_crop_to_plate. median_method selects the median
+    background algorithm (see appaloosa.Plate.median_background).
+    reuse_background has the waterfall stage correct the rescaled image by
+    the background median_correct stored; if False it median filters the
+    corrected image again, as before, which finds somewhat fewer basins.
+    """
+    # Load plate image
+    image = np.array(PIL.Image.open(image_filename))
+    plate = appaloosa.Plate(image=image,
+                            #image=imread(image_filename),
+                            tag_in='original_image',
+                            source_filename=image_filename,
+                            cache_dir=cache_dir,
+                            profile=profile,
+                            stash_memory_budget=(
+                                            None if stash_budget is None
+                                            else int(stash_budget * 1024**2)),
+                            spill_dir=spill_dir,
+                            copy_image=False,
+                           )
+    if intermediate_images:
+        plate.display(tag_in='original_image',
+                      figsize=intermediate_images_figsize,
+                      output_filename=(intermediate_prefix
+                                       + "original_image.png"),
+                     )
 
-# Measure basins
-plate.measure_basin_intensities(tag_in='corrected_rescaled_image',
-                                median_radius=None,
-                                filter_basins=True,
-                                radius_factor=None,
-                                basins_feature='overlaid_watershed_basins',
-                                feature_out='basin_intensities',
-                                multiplier=10.0,
-                               )
-plate.find_basin_centroids(tag_in='corrected_rescaled_image',
-                           basins_feature='overlaid_watershed_basins',
-                           feature_out='basin_centroids',
+    # Trim the outermost pixels a bit to make sure no background remains
+    # around the edges
+    percent_crop = 0.03
+    # Rescale image to standard size
+    # This is very important because the image morphology parameters we use
+    # for analysis are defined in terms of pixels and therefore are specific
+    # to a (ballpark) resolution.
+    target_scale = 500
+    if fast_crop:
+        # Segment, trim and rescale the plate in one go
+        plate.define_stage('fast_crop_to_plate',
+                           tag_in='original_image',
+                           tag_out='rescaled_image',
+                           feature_out='crop_rotation',
+                           target_scale=target_scale,
+                           border_fraction=percent_crop,
                           )
+    else:
+        # Segment the plates from the background
+        plate.define_stage('crop_to_plate',
+                           tag_in='original_image',
+                           tag_out='cropped_image',
+                           feature_out='crop_rotation',
+                           second_pass=False,
+                          )
+        if intermediate_images:
+            plate.display(tag_in='cropped_image',
+                          figsize=intermediate_images_figsize,
+                          output_filename=(intermediate_prefix
+                                           + "cropped_image.png"),
+                         )
 
-# Each spot is given a unique integer identifier
-#Its intensity is shown as I= <- this is currently omitted
-if args.intermediate_images:
-    plate.display(tag_in='rescaled_image',
-                  figsize=70,
-                  basins_feature='overlaid_watershed_basins',
-                  basin_alpha=0.1,
-                  baseline_feature=None,
-                  solvent_front_feature=None,
-                  lanes_feature=None,
-                  basin_centroids_feature='basin_centroids',
-                  basin_lane_assignments_feature=None,
-                  #basin_intensities_feature='basin_intensities',
-                  basin_rfs_feature=None,
-                  lines_feature=None,
-                  draw_boundaries=True,
-                  side_by_side=False,
-                  display_labels=True,
-                  output_filename="initial_output.png",
-                 )
-
-# Display basins in GUI and begin interactive segmentation
-plate.feature_stash['iterated_basins'] = \
-                        plate.feature_stash['overlaid_watershed_basins'].copy()
+        cropped_image = plate.image_stash['cropped_image']
+        cropped_image_height, cropped_image_width = cropped_image.shape[:2]
+        cropped_image_min_dimension = min(cropped_image_height,
+                                          cropped_image_width,
+                                         )
+        border = int(round(cropped_image_min_dimension * percent_crop))
+        plate.define_stage('crop_border',
+                           tag_in='cropped_image',
+                           tag_out='border_cropped_image',
+                           border=border,
+                          )
+        if intermediate_images:
+            plate.display(tag_in='border_cropped_image',
+                          figsize=intermediate_images_figsize,
+                          output_filename=(intermediate_prefix
+                                           + "border_cropped_image.png"),
+                         )
 
-resize_ratio = args.zoom
+        cropped_image = plate.image_stash['border_cropped_image']
+        cropped_height, cropped_width = cropped_image.shape[:2]
+        largest_dimension = max(cropped_height, cropped_width)
+        scaling_factor = float(target_scale) / largest_dimension
+        plate.define_stage('rescale_image',
+                           tag_in='border_cropped_image',
+                           tag_out='rescaled_image',
+                           scaling_factor=scaling_factor,
+                          )
+    if intermediate_images:
+        plate.display(tag_in='rescaled_image',
+                      figsize=intermediate_images_figsize,
+                      output_filename=(intermediate_prefix
+                                       + "rescaled_image.png"),
+                     )
 
-def make_pil_image(color_image,
-                   basins,
-                   resize_ratio=3,
-                   background_grid=5,
-                   assignment_feature='base_assignments',
-                  ):
-    if background_grid is not None:
-        gridded_image = color_image.copy()
-        for (h, w), basin in np.ndenumerate(basins):
-            if basin != 0:
-                continue
-            if h % background_grid != 0:
-                continue
-            if w % background_grid != 0:
-                continue
-            gridded_image[h, w] = 100
-        color_image = gridded_image
-    basin_boundaries = find_boundaries(basins,
-                                       mode='inner',
-                                      )
-    h, w, num_channels = color_image.shape
-    if num_channels == 4:
-        # If alpha channel is not treated separately, then alpha for boundaries
-        # becomes 1, so the boundaries appear white
-        boundaries_list = [basin_boundaries] * (num_channels - 1)
-        boundaries_list.append(np.zeros_like(basin_boundaries).astype(np.bool))
-    else:
-        boundaries_list = [basin_boundaries] * num_channels
-    stacked_boundaries = np.stack(boundaries_list,
-                                  axis=-1,
-                                 )
-    segmented_image = color_image * ~stacked_boundaries
-    global plate, baseline_colors, canvas
-    if (assignment_feature is not None
-        and assignment_feature in plate.feature_stash
-       ):
-        assignments = plate.feature_stash[assignment_feature]
-        for basin, base_assign_state in assignments.items():
-            isolated_basin = np.where(basins == basin,
-                                      1,
-                                      0,
-                                     )
-            isolated_boundary = find_boundaries(isolated_basin,
-                                                mode='inner',
-                                               )
-            if num_channels == 4:
-                boundaries_list = [isolated_boundary] * (num_channels - 1)
-                boundaries_list.append(
-                               np.zeros_like(isolated_boundary).astype(np.bool)
-                                      )
-            else:
-                boundaries_list = [isolated_boundary] * num_channels
-            stacked_boundaries = np.stack(boundaries_list,
-                                          axis=-1,
-                                         )
-            baseline_color = baseline_colors[base_assign_state - 1]
-            baseline_rgb = canvas.winfo_rgb(baseline_color) # 16-bit
-            imin, imax = dtype_limits(color_image, clip_negative=False)
-            baseline_r = float(baseline_rgb[0]) * imax / 65535
-            baseline_g = float(baseline_rgb[1]) * imax / 65535
-            baseline_b = float(baseline_rgb[2]) * imax / 65535
-            for (h, w), boundary in np.ndenumerate(isolated_boundary):
-                if boundary:
-                    segmented_image[h, w, 0] = baseline_r
-                    segmented_image[h, w, 1] = baseline_g
-                    segmented_image[h, w, 2] = baseline_b
-    uint8_image = np.rint(segmented_image * 255).astype(np.uint8)
-    pil_image = Image.fromarray(uint8_image)
-    #display_size = 1000
-    image_width, image_height = pil_image.size
-    #resize_ratio = min(float(display_size) / image_width,
-    #                   float(display_size) / image_height,
-    #                  )
-    resized_width = int(round(image_width * resize_ratio))
-    resized_height = int(round(image_height * resize_ratio))
-    pil_image = pil_image.resize((resized_width, resized_height))
-    return pil_image
+    # Median correct the image to correct uneven intensity over the plate
+    plate.define_stage('median_correct',
+                       tag_in='rescaled_image',
+                       tag_out='corrected_rescaled_image',
+                       median_disk_radius=31,
+                       method=median_method,
+                       background_out=('rescaled_background'
+                                       if reuse_background else None),
+                      )
+    if intermediate_images:
+        plate.display(tag_in='corrected_rescaled_image',
+                      figsize=intermediate_images_figsize,
+                      output_filename=(intermediate_prefix
+                                       + "corrected_rescaled_image.png"),
+                     )
 
-#meshgrid would be faster, but I this is easier to understand
-background_grid = np.zeros_like(plate.feature_stash['iterated_basins'])
-grid_spacing = 3
-for h, w in np.ndindex(background_grid.shape):
-    if h % grid_spacing == 0 and w % grid_spacing == 0:
-        background_grid[h, w] = 1
-background_ovals = []
+    # Let's try segmenting the spots using the waterfall algorithm
+    plate.define_stage('waterfall_segmentation',
+                       tag_in=('rescaled_image' if reuse_background
+                               else 'corrected_rescaled_image'),
+                       feature_out='waterfall_basins',
+                       R_out='R_img',
+                       mg_out='mg_img',
+                       median_disk_radius=31,
+                       smoothing_sigma=2,
+                       threshold_opening_size=2,
+                       basin_open_close_size=5,
+                       skeleton_label=0,
+                       debug_output=False,
+                       median_method=median_method,
+                       background_tag=('rescaled_background'
+                                       if reuse_background else None),
+                      )
+    if intermediate_images:
+        plate.display(tag_in='corrected_rescaled_image',
+                      basins_feature='waterfall_basins',
+                      figsize=intermediate_images_figsize,
+                      output_filename=(intermediate_prefix
+                                       + "waterfall_basins.png"),
+                     )
 
-def grid_background(canvas,
-                    basins,
-                   ):
-    global background_grid
-    this_grid = np.where(basins == 0,
-                         background_grid,
-                         0,
-                        )
-    global background_ovals
-    background_ovals = []
-    oval_radius = 3
-    global resize_ratio
-    for (h, w), g in np.ndenumerate(this_grid):
-        if g == 1:
-            oval = canvas.create_oval(w * resize_ratio - oval_radius,
-                                      h * resize_ratio - oval_radius,
-                                      w * resize_ratio + oval_radius,
-                                      h * resize_ratio + oval_radius,
-                                      width=0,
-                                      fill='gray',
-                                     )
-            background_ovals.append(oval)
+    # The largest item found is the background; we need to get rid of it
+    plate.define_stage('remove_most_frequent_label',
+                       basins_feature='waterfall_basins',
+                       feature_out='filtered_waterfall_basins',
+                       debug_output=False,
+                      )
+
+    # Overlay finegrained watershed over waterfall segmentation
+    plate.define_stage('overlay_watershed',
+                       tag_in='corrected_rescaled_image',
+                       intensity_image_tag='corrected_rescaled_image',
+                       median_radius=None,
+                       filter_basins=True,
+                       waterfall_basins_feature='filtered_waterfall_basins',
+                       feature_out='overlaid_watershed_basins',
+                       min_localmax_dist=5,
+                       smoothing_sigma=1,
+                       min_area=10,
+                       min_intensity=0.1,
+                       rp_radius_factor=None,
+                       debug_output=False,
+                       basin_open_close_size=None,
+                      )
+    if intermediate_images:
+        plate.display(tag_in='corrected_rescaled_image',
+                      basins_feature='overlaid_watershed_basins',
+                      figsize=intermediate_images_figsize,
+                      output_filename=(intermediate_prefix
+                                       + 'overlaid_watershed_basins.png'),
+                     )
 
-root = tk.Tk()
-color_image = plate.image_stash['rescaled_image']
-pil_image = make_pil_image(color_image=color_image,
-                           basins=plate.feature_stash['iterated_basins'],
-                           resize_ratio=resize_ratio,
-                          )
-frame = tk.Frame(root,width=500,height=500)
-frame.pack(expand=True, fill=tk.BOTH)
-tk_image = ImageTk.PhotoImage(master=frame,
-                              image=pil_image,
-                             )
-image_width, image_height = pil_image.size
-canvas = tk.Canvas(frame,
-                   width=500,
-                   height=500,
-                   scrollregion=(0,0,image_width,image_height)
-                  )
-hbar=tk.Scrollbar(frame,orient=tk.HORIZONTAL)
-hbar.pack(side=tk.BOTTOM,fill=tk.X)
-hbar.config(command=canvas.xview)
-vbar=tk.Scrollbar(frame,orient=tk.VERTICAL)
-vbar.pack(side=tk.RIGHT,fill=tk.Y)
-vbar.config(command=canvas.yview)
-canvas.config(width=500,height=500)
-canvas.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
-canvas.pack(side=tk.LEFT,expand=True,fill=tk.BOTH)
-canvas_image = canvas.create_image(0, 0,
-                                   anchor='nw',
-                                   image=tk_image,
-                                  )
-bottom_frame = tk.Frame(root)
-bottom_frame.pack(side=tk.BOTTOM)
-quit_button = tk.Button(bottom_frame,
-                        text="Quit",
-                        command=quit,
-                       )
-quit_button.grid(column=0, row=1)
+    # Measure basins
+    plate.define_stage('measure_basin_intensities',
+                       tag_in='corrected_rescaled_image',
+                       median_radius=None,
+                       filter_basins=True,
+                       radius_factor=None,
+                       basins_feature='overlaid_watershed_basins',
+                       feature_out='basin_intensities',
+                       multiplier=10.0,
+                      )
+    plate.define_stage('find_basin_centroids',
+                       tag_in='corrected_rescaled_image',
+                       basins_feature='overlaid_watershed_basins',
+                       feature_out='basin_centroids',
+                      )
+
+    # Each spot is given a unique integer identifier
+    #Its intensity is shown as I= <- this is currently omitted
+    if intermediate_images:
+        plate.display(tag_in='rescaled_image',
+                      figsize=70,
+                      basins_feature='overlaid_watershed_basins',
+                      basin_alpha=0.1,
+                      baseline_feature=None,
+                      solvent_front_feature=None,
+                      lanes_feature=None,
+                      basin_centroids_feature='basin_centroids',
+                      basin_lane_assignments_feature=None,
+                      #basin_intensities_feature='basin_intensities',
+                      basin_rfs_feature=None,
+                      lines_feature=None,
+                      draw_boundaries=True,
+                      side_by_side=False,
+                      display_labels=True,
+                      output_filename=(intermediate_prefix
+                                       + "initial_output.png"),
+                     )
+    return plate
 
 def order_centroids(basin_centroids,
                     line,
@@ -406,9 +423,14 @@ def order_centroids(basin_centroids,
                 }
     return basin_map
 
-
-def on_save():
-    global plate
+def save_plate(plate,
+               output_basename,
+               basins_feature='iterated_basins',
+              ):
+    """
+    Write <output_basename>_segmented.png and <output_basename>_intensities.csv
+    for a segmented and measured plate.
+    """
     basin_centroids = plate.feature_stash['basin_centroids']
     solvent_front = plate.feature_stash.get('solvent_front', None)
     if solvent_front is not None:
@@ -417,20 +439,16 @@ def on_save():
                                    )
     else:
         basin_map = {basin: basin for basin in basin_centroids.keys()}
-    basins = plate.feature_stash['iterated_basins']
-    sorted_basins = np.zeros_like(basins)
-    for basin, sorted_basin in basin_map.items():
-        sorted_basins = np.where(basins == basin,
-                                 sorted_basin,
-                                 sorted_basins,
-                                )
+    basins = plate.feature_stash[basins_feature]
+    sorted_basins = appaloosa.Plate.relabel(basins=basins,
+                                            mapping=basin_map,
+                                            keep_unmapped=False,
+                                           )
     plate.feature_stash['sorted_basins'] = sorted_basins
     sorted_centroids = {basin_map[basin]: centroid
                         for basin, centroid in basin_centroids.items()
                        }
     plate.feature_stash['sorted_centroids'] = sorted_centroids
-    epoch_hash = appaloosa.epoch_to_hash(time.time())
-    output_basename = epoch_hash
     print(("Saving using basename " + str(output_basename)))
     image_filename = output_basename + "_segmented.png"
     plate.display(tag_in='rescaled_image',
@@ -475,31 +493,447 @@ def on_save():
             basin_row = [sorted_basin, intensity, base_assign_state, rf]
             csv_writer.writerow(basin_row)
     print("Finished writing CSV.")
+    if plate.stage_profile is not None:
+        plate.save_profile_json(output_basename + "_profile.json")
+        plate.save_profile_csv(output_basename + "_profile.csv")
 
-save_button = tk.Button(bottom_frame,
-                        text="Save & Quit",
-                        command=on_save,
-                       )
-save_button.grid(column=1, row=1)
+batch_image_extensions = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
 
-def alive():
-    print("Alive!")
+def batch_image_filenames(pattern):
+    if os.path.isdir(pattern):
+        candidates = glob(os.path.join(pattern, '*'))
+    else:
+        candidates = glob(pattern)
+    image_filenames = sorted(filename for filename in candidates
+                             if os.path.isfile(filename)
+                             and (os.path.splitext(filename)[1].lower()
+                                  in batch_image_extensions)
+                            )
+    return image_filenames
+
+def batch_output_stems(image_filenames):
+    """
+    Output file stem for each image filename: its name without extension,
+    unless that is shared with another image (a.jpg and a.png, or the same
+    name in two directories). Those get their path relative to the images'
+    common directory instead, extension included, with separators and dots
+    replaced by underscores.
+    """
+    stems = [os.path.splitext(os.path.basename(image_filename))[0]
+             for image_filename in image_filenames]
+    stem_counts = defaultdict(int)
+    for stem in stems:
+        stem_counts[stem] += 1
+    common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(f))
+                                     for f in image_filenames])
+    for i, image_filename in enumerate(image_filenames):
+        if stem_counts[stems[i]] > 1:
+            relative_path = os.path.relpath(os.path.abspath(image_filename),
+                                            common_dir,
+                                           )
+            stems[i] = (relative_path
+                        .replace(os.sep, '_')
+                        .replace('.', '_'))
+    if len(set(stems)) < len(stems):
+        raise ValueError("Plate images map to clashing output names.")
+    return stems
+
+def batch_segment_plate(job):
+    """
+    Segment and save one plate. Returns (image_filename, output_basename,
+    error), error being None or the traceback of the exception that stopped
+    this plate, so that one bad plate does not end the batch.
+    """
+    (image_filename,
+     output_basename,
+     intermediate_images,
+     cache_dir,
+     profile,
+     stash_budget,
+     spill_dir,
+     fast_crop,
+     median_method,
+     reuse_background,
+    ) = job
+    try:
+        plate = segment_plate(image_filename=image_filename,
+                              intermediate_images=intermediate_images,
+                              intermediate_prefix=output_basename + "_",
+                              cache_dir=cache_dir,
+                              profile=profile,
+                              stash_budget=stash_budget,
+                              spill_dir=spill_dir,
+                              fast_crop=fast_crop,
+                              median_method=median_method,
+                              reuse_background=reuse_background,
+                             )
+        save_plate(plate=plate,
+                   output_basename=output_basename,
+                   basins_feature='overlaid_watershed_basins',
+                  )
+    except Exception:
+        return image_filename, output_basename, traceback.format_exc()
+    return image_filename, output_basename, None
+
+def run_batch(pattern,
+              output_dir='.',
+              workers=None,
+              intermediate_images=False,
+              cache_dir=None,
+              profile=False,
+              stash_budget=None,
+              spill_dir=None,
+              fast_crop=False,
+              median_method='filter',
+              reuse_background=True,
+             ):
+    """
+    Segment every plate image pattern matches. Returns the (image_filename,
+    traceback) of each plate that failed; the others are still processed.
+    """
+    image_filenames = batch_image_filenames(pattern)
+    if not image_filenames:
+        print(("No plate images found for " + str(pattern)))
+        return []
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    output_stems = batch_output_stems(image_filenames)
+    jobs = [(image_filename,
+             os.path.join(output_dir, output_stem),
+             intermediate_images,
+             cache_dir,
+             profile,
+             stash_budget,
+             spill_dir,
+             fast_crop,
+             median_method,
+             reuse_background,
+            )
+            for image_filename, output_stem
+            in zip(image_filenames, output_stems)]
+    print(("Segmenting " + str(len(jobs)) + " plates..."))
+    failures = []
+    pool = multiprocessing.Pool(processes=workers,
+                                maxtasksperchild=None,
+                               )
+    try:
+        for image_filename, output_basename, error in pool.imap_unordered(
+                                                           batch_segment_plate,
+                                                           jobs,
+                                                                         ):
+            if error is None:
+                print((str(image_filename) + " -> " + str(output_basename)))
+            else:
+                print((str(image_filename) + " FAILED"))
+                failures.append((image_filename, error))
+    finally:
+        pool.close()
+        pool.join()
+    for image_filename, error in failures:
+        print(("\n" + str(image_filename) + " failed:\n" + error))
+    print(("Batch complete: " + str(len(jobs) - len(failures))
+           + " plates segmented, " + str(len(failures)) + " failed."))
+    return failures
+
+def composite_basins(color_image,
+                     basins,
+                     window=None,
+                     background_grid=5,
+                     assignments=None,
+                    ):
+    """
+    Composite the gridded background, basin boundaries and the baseline
+    colours of assigned basins over color_image, returning a uint8 image of
+    window (an (h, w) slice pair; None for the whole plate).
+    """
+    image_height, image_width = basins.shape[:2]
+    if window is None:
+        window = slice(0, image_height), slice(0, image_width)
+    h_slice, w_slice = window
+    # find_boundaries needs one pixel of context around the window
+    padded_window = (slice(max(0, h_slice.start - 1),
+                           min(image_height, h_slice.stop + 1)),
+                     slice(max(0, w_slice.start - 1),
+                           min(image_width, w_slice.stop + 1)),
+                    )
+    inner_window = (slice(h_slice.start - padded_window[0].start,
+                          h_slice.stop - padded_window[0].start),
+                    slice(w_slice.start - padded_window[1].start,
+                          w_slice.stop - padded_window[1].start),
+                   )
+    padded_basins = basins[padded_window]
+    color_image = color_image[window]
+    basins = basins[window]
+    if background_grid is not None:
+        gridded_image = color_image.copy()
+        grid_rows = (np.arange(h_slice.start, h_slice.stop)
+                     % background_grid == 0)
+        grid_columns = (np.arange(w_slice.start, w_slice.stop)
+                        % background_grid == 0)
+        grid_mask = np.logical_and(np.outer(grid_rows, grid_columns),
+                                   basins == 0,
+                                  )
+        gridded_image[grid_mask] = 100
+        color_image = gridded_image
+    # The inner boundary of a single isolated basin is exactly the inner
+    # boundary of the full label image restricted to that basin, so one
+    # boundary pass serves both the outlines and the assignment colouring
+    basin_boundaries = find_boundaries(padded_basins,
+                                       mode='inner',
+                                      )[inner_window]
+    h, w, num_channels = color_image.shape
+    if num_channels == 4:
+        # If alpha channel is not treated separately, then alpha for boundaries
+        # becomes 1, so the boundaries appear white
+        boundaries_list = [basin_boundaries] * (num_channels - 1)
+        boundaries_list.append(np.zeros_like(basin_boundaries).astype(np.bool))
+    else:
+        boundaries_list = [basin_boundaries] * num_channels
+    stacked_boundaries = np.stack(boundaries_list,
+                                  axis=-1,
+                                 )
+    segmented_image = color_image * ~stacked_boundaries
+    if assignments:
+        color_table, assigned_table = assignment_color_table(
+                                      assignments=assignments,
+                                      max_label=basins.max(),
+                                      imax=dtype_limits(color_image,
+                                                        clip_negative=False,
+                                                       )[1],
+                                                            )
+        colored_boundaries = np.logical_and(basin_boundaries,
+                                            assigned_table[basins],
+                                           )
+        segmented_image[colored_boundaries, :3] = (
+                                   color_table[basins[colored_boundaries]])
+    uint8_image = np.rint(segmented_image * 255).astype(np.uint8)
+    return uint8_image
+
+def assignment_color_table(assignments,
+                           max_label,
+                           imax=1,
+                          ):
+    """
+    Label -> RGB lookup table from baseline assignments and baseline_colors,
+    scaled to imax, along with a table flagging which labels are assigned.
+    """
+    global baseline_colors, canvas
+    table_size = max(int(max_label), max(assignments)) + 1
+    color_table = np.zeros((table_size, 3))
+    assigned_table = np.zeros(table_size, dtype=np.bool)
+    state_rgbs = {}
+    for basin, base_assign_state in assignments.items():
+        if base_assign_state not in state_rgbs:
+            baseline_color = baseline_colors[base_assign_state - 1]
+            baseline_rgb = canvas.winfo_rgb(baseline_color) # 16-bit
+            state_rgbs[base_assign_state] = [float(channel) * imax / 65535
+                                             for channel in baseline_rgb]
+        color_table[basin] = state_rgbs[base_assign_state]
+        assigned_table[basin] = True
+    return color_table, assigned_table
+
+def label_bbox(mask):
+    """(h, w) slice pair bounding the True pixels of mask, or None."""
+    rows, columns = np.any(mask, axis=1), np.any(mask, axis=0)
+    if not np.any(rows):
+        return None
+    row_indices, column_indices = np.nonzero(rows)[0], np.nonzero(columns)[0]
+    return (slice(row_indices[0], row_indices[-1] + 1),
+            slice(column_indices[0], column_indices[-1] + 1),
+           )
+
+def union_bbox(bbox_A, bbox_B):
+    if bbox_A is None:
+        return bbox_B
+    if bbox_B is None:
+        return bbox_A
+    return tuple(slice(min(a.start, b.start), max(a.stop, b.stop))
+                 for a, b in zip(bbox_A, bbox_B))
+
+class BasinRenderer(object):
+    """
+    Keeps the last composited frame, the labels and assignments it was drawn
+    from and the resized PIL image, so that a redraw only recomposites and
+    rescales the region whose labels or assignments changed and pastes it
+    into the existing image.
+    """
+    def __init__(self):
+        self.color_image = None
+        self.basins = None
+        self.assignments = None
+        self.settings = None
+        self.frame = None
+        self.pil_image = None
+
+    def render(self,
+               color_image,
+               basins,
+               resize_ratio=3,
+               background_grid=5,
+               assignments=None,
+               changed_bbox=None,
+              ):
+        """
+        changed_bbox: (h, w) slice pair covering every label that changed
+                      since the last render; found by comparing against the
+                      previous labels if None.
+        """
+        assignments = dict(assignments) if assignments is not None else None
+        settings = (resize_ratio, background_grid)
+        if (self.frame is None
+            or color_image is not self.color_image
+            or basins.shape != self.basins.shape
+            or settings != self.settings
+           ):
+            self.frame = composite_basins(color_image=color_image,
+                                          basins=basins,
+                                          background_grid=background_grid,
+                                          assignments=assignments,
+                                         )
+            pil_image = Image.fromarray(self.frame)
+            image_width, image_height = pil_image.size
+            resized_width = int(round(image_width * resize_ratio))
+            resized_height = int(round(image_height * resize_ratio))
+            self.pil_image = pil_image.resize((resized_width, resized_height))
+        else:
+            if changed_bbox is None:
+                changed_bbox = label_bbox(basins != self.basins)
+            old_assignments = self.assignments or {}
+            new_assignments = assignments or {}
+            recoloured = [basin
+                          for basin in set(old_assignments) | set(new_assignments)
+                          if old_assignments.get(basin)
+                             != new_assignments.get(basin)]
+            if recoloured:
+                recoloured_mask = (np.isin(basins, recoloured)
+                                   | np.isin(self.basins, recoloured))
+                changed_bbox = union_bbox(changed_bbox,
+                                          label_bbox(recoloured_mask),
+                                         )
+            if changed_bbox is not None:
+                self.render_region(color_image=color_image,
+                                   basins=basins,
+                                   changed_bbox=changed_bbox,
+                                   background_grid=background_grid,
+                                   assignments=assignments,
+                                  )
+        self.color_image = color_image
+        self.basins = basins.copy()
+        self.assignments = assignments
+        self.settings = settings
+        return self.pil_image
+
+    def render_region(self,
+                      color_image,
+                      basins,
+                      changed_bbox,
+                      background_grid,
+                      assignments,
+                     ):
+        image_height, image_width = basins.shape[:2]
+        h_slice, w_slice = changed_bbox
+        # Boundary status of pixels next to a changed label can change too
+        window = (slice(max(0, h_slice.start - 1),
+                        min(image_height, h_slice.stop + 1)),
+                  slice(max(0, w_slice.start - 1),
+                        min(image_width, w_slice.stop + 1)),
+                 )
+        self.frame[window] = composite_basins(color_image=color_image,
+                                              basins=basins,
+                                              window=window,
+                                              background_grid=background_grid,
+                                              assignments=assignments,
+                                             )
+        # Rescale only the affected part of the canvas image. Resizing with a
+        # source box that covers the resampling filter's reach samples
+        # nearly as the full-image resize does: pixels can differ by a level
+        # or two, at most, where PIL rounds the box's filter weights
+        # differently.
+        resized_width, resized_height = self.pil_image.size
+        scale_w = float(image_width) / resized_width
+        scale_h = float(image_height) / resized_height
+        margin_w, margin_h = 3 * max(1, scale_w), 3 * max(1, scale_h)
+        min_dw = max(0, int(np.floor((window[1].start - margin_w) / scale_w)))
+        max_dw = min(resized_width,
+                     int(np.ceil((window[1].stop + margin_w) / scale_w)))
+        min_dh = max(0, int(np.floor((window[0].start - margin_h) / scale_h)))
+        max_dh = min(resized_height,
+                     int(np.ceil((window[0].stop + margin_h) / scale_h)))
+        region = Image.fromarray(self.frame).resize(
+                                             (max_dw - min_dw, max_dh - min_dh),
+                                             box=(min_dw * scale_w,
+                                                  min_dh * scale_h,
+                                                  max_dw * scale_w,
+                                                  max_dh * scale_h,
+                                                 ),
+                                                   )
+        self.pil_image.paste(region, (min_dw, min_dh))
+
+basin_renderer = BasinRenderer()
 
-alive_button = tk.Button(bottom_frame,
-                         text="Alive?",
-                         command=alive,
+def make_pil_image(color_image,
+                   basins,
+                   resize_ratio=3,
+                   background_grid=5,
+                   assignment_feature='base_assignments',
+                   changed_bbox=None,
+                  ):
+    global plate, basin_renderer
+    if (assignment_feature is not None
+        and assignment_feature in plate.feature_stash
+       ):
+        assignments = plate.feature_stash[assignment_feature]
+    else:
+        assignments = None
+    pil_image = basin_renderer.render(color_image=color_image,
+                                      basins=basins,
+                                      resize_ratio=resize_ratio,
+                                      background_grid=background_grid,
+                                      assignments=assignments,
+                                      changed_bbox=changed_bbox,
+                                     )
+    return pil_image
+grid_spacing = 3
+background_ovals = []
+
+def grid_background(canvas,
+                    basins,
+                   ):
+    global background_grid
+    this_grid = np.where(basins == 0,
+                         background_grid,
+                         0,
                         )
-alive_button.grid(column=8, row=1)
+    global background_ovals
+    background_ovals = []
+    oval_radius = 3
+    global resize_ratio
+    for (h, w), g in np.ndenumerate(this_grid):
+        if g == 1:
+            oval = canvas.create_oval(w * resize_ratio - oval_radius,
+                                      h * resize_ratio - oval_radius,
+                                      w * resize_ratio + oval_radius,
+                                      h * resize_ratio + oval_radius,
+                                      width=0,
+                                      fill='gray',
+                                     )
+            background_ovals.append(oval)
 
-maxima_distance_label = tk.Label(bottom_frame,
-                                 text="Subdivision resolution",
-                                )
-maxima_distance_label.grid(column=0, row=2)
-maxima_distance_entry = tk.Entry(bottom_frame)
-maxima_distance_entry.insert(0, 2)
-maxima_distance_entry.grid(column=1, row=2)
+def on_save():
+    global plate
+    epoch_hash = appaloosa.epoch_to_hash(time.time())
+    output_basename = epoch_hash
+    save_plate(plate=plate,
+               output_basename=output_basename,
+               basins_feature='iterated_basins',
+              )
+
+def alive():
+    print("Alive!")
 
 def remeasure_basins(plate):
+    #Only labels touched since the last remeasurement are measured again
+    changed_labels, changed_bbox = plate.pop_label_changes('iterated_basins')
     plate.measure_basin_intensities(tag_in='corrected_rescaled_image',
                                     median_radius=None,
                                     filter_basins=True,
@@ -507,10 +941,13 @@ def remeasure_basins(plate):
                                     basins_feature='iterated_basins',
                                     feature_out='basin_intensities',
                                     multiplier=10.0,
+                                    changed_labels=changed_labels,
+                                    changed_bbox=changed_bbox,
                                    )
     plate.find_basin_centroids(tag_in='corrected_rescaled_image',
                                basins_feature='iterated_basins',
                                feature_out='basin_centroids',
+                               changed_labels=changed_labels,
                               )
 
 left_click_buffer = []
@@ -529,11 +966,12 @@ def right_click(event):
     if basin == 0:
         print("This is background; not deleting.")
         return
-    basins = np.where(basins == basin,
-                      0,
-                      basins,
-                     )
-    plate.feature_stash['iterated_basins'] = basins
+    basins = appaloosa.Plate.relabel(basins=basins,
+                                     mapping={basin: 0},
+                                    )
+    plate.update_basins(basins_feature='iterated_basins',
+                        basins=basins,
+                       )
     remeasure_basins(plate)
     color_image = plate.image_stash['rescaled_image']
     pil_image = make_pil_image(color_image=color_image,
@@ -547,8 +985,6 @@ def right_click(event):
     #               )
     stdout.write("complete\n")
     stdout.flush()
-    
-canvas.bind('<Button 3>', right_click)
 
 def subdivide_spot():
     stdout.write("Subdivision...")
@@ -585,12 +1021,6 @@ def subdivide_spot():
     stdout.write("complete\n")
     stdout.flush()
 
-linear_split_button = tk.Button(bottom_frame,
-                                text="Watershed subdivide spot",
-                                command=subdivide_spot,
-                               )
-linear_split_button.grid(column=3, row=2)
-
 def left_click(event):
     w, h = canvas.canvasx(event.x), canvas.canvasy(event.y)
     global left_click_buffer, left_click_buffer_size, left_click_shapes
@@ -609,8 +1039,6 @@ def left_click(event):
     for oval in left_click_shapes[:-left_click_buffer_size]:
         canvas.delete(oval)
 
-canvas.bind('<Button 1>', left_click)
-
 def linear_split():
     stdout.write("Subdivision...")
     stdout.flush()
@@ -646,13 +1074,6 @@ def linear_split():
     stdout.write("complete\n")
     stdout.flush()
 
-
-linear_split_button = tk.Button(bottom_frame,
-                                text="Linear split",
-                                command=linear_split,
-                               )
-linear_split_button.grid(column=4, row=1)
-
 solvent_front = None
 solvent_front_line = None
 
@@ -682,12 +1103,6 @@ def solvent():
     solvent_front_line = ((mapped_w1, mapped_h1), (mapped_w2, mapped_h2))
     solvent_front = canvas.create_line(ew1, eh1, ew2, eh2, fill='red')
 
-solvent_front_button = tk.Button(bottom_frame,
-                                 text="Solvent front",
-                                 command=solvent,
-                                )
-solvent_front_button.grid(column=5, row=1)
-
 baseline_colors = ['orange',
                    'orange red',
                    'deep pink',
@@ -734,12 +1149,6 @@ def add_baseline():
     baseline_color = baseline_colors[len(baselines) - 1]
     baseline = canvas.create_line(ew1, eh1, ew2, eh2, fill=baseline_color)
 
-baseline_button = tk.Button(bottom_frame,
-                            text="Add baseline",
-                            command=add_baseline,
-                           )
-baseline_button.grid(column=6, row=1)
-
 base_assign_state = 0
 
 def base1_assign():
@@ -818,30 +1227,6 @@ def base4_assign():
         base3_assign_button.config(relief=tk.RAISED)
         base4_assign_button.config(relief=tk.RAISED)
 
-base1_assign_button = tk.Button(bottom_frame,
-                                text="1",
-                                command=base1_assign,
-                               )
-base1_assign_button.grid(column=4, row=2)
-
-base2_assign_button = tk.Button(bottom_frame,
-                                text="2",
-                                command=base2_assign,
-                                )
-base2_assign_button.grid(column=5, row=2)
-
-base3_assign_button = tk.Button(bottom_frame,
-                                text="3",
-                                command=base3_assign,
-                               )
-base3_assign_button.grid(column=6, row=2)
-
-base4_assign_button = tk.Button(bottom_frame,
-                                text="4",
-                                command=base4_assign,
-                               )
-base4_assign_button.grid(column=7, row=2)
-
 def assign(event):
     global base_assign_state, plate, canvas, canvas_image, pil_image, tk_image
     global resize_ratio
@@ -879,9 +1264,25 @@ def assign(event):
                             baseline_feature='temp_baseline',
                             solvent_front_feature='solvent_front',
                             feature_out='temp_basin_rfs',
+                            flags_out='temp_basin_rf_flags',
                            )
+    #Spots without a well-defined Rf (e.g. beyond the baseline or solvent
+    #front) are reported and left without an Rf
+    rf_flags = plate.feature_stash['temp_basin_rf_flags']
+    flagged_basins = sorted(Label for Label, valid in rf_flags.items()
+                            if not valid)
+    if flagged_basins:
+        print(("No well-defined Rf for spots "
+               + ", ".join(str(Label) for Label in flagged_basins)
+               + " on baseline #" + str(base_assign_state)
+               + "; skipped."
+              ))
     indexed_basin_rfs = plate.feature_stash.setdefault('indexed_basin_rfs', {})
-    indexed_basin_rfs[base_assign_state] = plate.feature_stash['temp_basin_rfs']
+    indexed_basin_rfs[base_assign_state] = {
+                            Label: rf
+                            for Label, rf
+                            in plate.feature_stash['temp_basin_rfs'].items()
+                            if rf_flags[Label]}
     color_image = plate.image_stash['rescaled_image']
     pil_image = make_pil_image(color_image=color_image,
                                basins=plate.feature_stash['iterated_basins'],
@@ -891,27 +1292,14 @@ def assign(event):
     tk_image = ImageTk.PhotoImage(image=pil_image)
     canvas.itemconfig(canvas_image, image=tk_image)
 
-canvas.bind('<Double-Button-1>', assign)
-
-canvas.focus_set()
-
 basin_texts = {}
 
-def make_boolean_circle(image,
-                        h, w,
-                        radius,
-                       ):
-    h, w, radius = int(round(h)), int(round(w)), int(round(radius))
-    image_height, image_width = image.shape[:2]
-    hh, ww = np.mgrid[:image_height,:image_width]
-    radial_distance_sq = (hh - h)**2 + (ww - w)**2
-    boolean_circle_array = (radial_distance_sq <= radius**2)
-    return boolean_circle_array
-
 def circle_filter(image,
                   basins,
                   basin,
                   radius,
+                  disk_means=None,
+                  basin_slice=None,
                  ):
     (best_h,
      best_w,
@@ -922,32 +1310,231 @@ def circle_filter(image,
                        basins=basins,
                        basin=basin,
                        radius=radius,
+                       disk_means=disk_means,
                                    )
-    logical_filter = np.where((basins == basin) & ~best_circle,
-                              True,
-                              False,
-                             )
-    updated_basins = np.where(logical_filter,
-                              np.zeros_like(basins),
-                              basins,
-                             )
+    updated_basins = basins.copy()
+    if best_circle is None:
+        return updated_basins
+    appaloosa.Plate.clip_label_to_circle(basins=updated_basins,
+                                         basin=basin,
+                                         circle=best_circle,
+                                         basin_slice=basin_slice,
+                                        )
     return updated_basins
 
 def circle_filter_all(image,
                       basins,
                       radius,
                      ):
-    basin_set = set(basins.reshape(-1))
-    updated_basins = basins
-    for basin in iter(basin_set):
-        updated_basins = circle_filter(image=image,
-                                       basins=updated_basins,
-                                       basin=basin,
+    disk_means = appaloosa.Plate.disk_mean_image(image=image, radius=radius)
+    updated_basins = basins.copy()
+    basin_slices = ndi.find_objects(basins)
+    for basin, basin_slice in enumerate(basin_slices, start=1):
+        if basin_slice is None:
+            continue
+        (best_h,
+         best_w,
+         best_circle,
+         best_value,
+        ) = appaloosa.Plate.best_circle(
+                           image=image[basin_slice],
+                           basins=updated_basins[basin_slice],
+                           basin=basin,
+                           radius=radius,
+                           disk_means=disk_means[basin_slice],
+                                       )
+        best_circle = appaloosa.Plate.make_local_circle(
+                                       image=image,
+                                       h=best_h + basin_slice[0].start,
+                                       w=best_w + basin_slice[1].start,
                                        radius=radius,
+                                                       )
+        appaloosa.Plate.clip_label_to_circle(basins=updated_basins,
+                                             basin=basin,
+                                             circle=best_circle,
+                                             basin_slice=basin_slice,
+                                            )
+    return updated_basins
+
+# Arrays shared with the circle filter workers, keyed by role: (shared memory
+# block, array view) in the main process, and attachments by block name in
+# the workers
+shared_arrays = {}
+attached_arrays = {}
+
+class MemmapBlock(object):
+    """
+    Stand-in for multiprocessing.shared_memory.SharedMemory on Pythons before
+    3.8: a temporary file that every process maps.
+    """
+    def __init__(self, name=None, create=False, size=0):
+        if create:
+            file_descriptor, name = tempfile.mkstemp(prefix='appaloosa_shm_')
+            os.close(file_descriptor)
+            with open(name, 'r+b') as block_file:
+                block_file.truncate(size)
+        self.name = name
+        self.buf = np.memmap(name, dtype=np.uint8, mode='r+')
+
+    def close(self):
+        self.buf = None
+
+    def unlink(self):
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+def shared_block(name=None, create=False, size=0):
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return MemmapBlock(name=name, create=create, size=size)
+    return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+def publish_shared_array(key, array):
+    """
+    Copy array into the shared memory block kept for key, replacing the block
+    if the shape or dtype changed. Returns the spec workers attach with.
+    """
+    global shared_arrays
+    array = np.ascontiguousarray(array)
+    block = shared_arrays.get(key)
+    if (block is None
+        or block[1].shape != array.shape
+        or block[1].dtype != array.dtype
+       ):
+        if block is not None:
+            block[0].close()
+            block[0].unlink()
+        shm = shared_block(create=True,
+                           size=max(1, array.nbytes),
+                          )
+        view = np.ndarray(array.shape,
+                          dtype=array.dtype,
+                          buffer=shm.buf,
+                         )
+        block = shared_arrays[key] = shm, view
+    block[1][...] = array
+    return block[0].name, array.shape, array.dtype.str
+
+def attach_shared_array(spec):
+    global attached_arrays
+    name, shape, dtype = spec
+    if name not in attached_arrays:
+        shm = shared_block(name=name)
+        attached_arrays[name] = shm, np.ndarray(shape,
+                                                dtype=dtype,
+                                                buffer=shm.buf,
+                                               )
+    return attached_arrays[name][1]
+
+def isolated_blob_log(job):
+    """
+    appaloosa.Plate.isolated_window_blobs on one basin of the shared image
+    and label map.
+    """
+    image_spec, basins_spec, basin, window, background, blob_params = job
+    blobs = appaloosa.Plate.isolated_window_blobs(
+                                      image=attach_shared_array(image_spec),
+                                      basins=attach_shared_array(basins_spec),
+                                      basin=basin,
+                                      window=window,
+                                      background=background,
+                                      **blob_params
+                                                 )
+    return basin, blobs
+
+def pooled_blob_finder(image,
+                       basins,
+                       background,
+                       windows,
+                       blob_params,
+                      ):
+    """
+    blob_finder for appaloosa.Plate.find_basin_blobs that spreads the basins
+    over the circle filter pool. Workers read the image and labels from
+    shared memory and get only a basin and its window.
+    """
+    image_spec = publish_shared_array(key='blob_image',
+                                      array=image,
+                                     )
+    basins_spec = publish_shared_array(key='blob_basins',
+                                       array=basins,
                                       )
+    jobs = [(image_spec, basins_spec, basin, window, background, blob_params)
+            for basin, window in windows.items()]
+    pool = get_circle_filter_pool()
+    return pool.imap_unordered(isolated_blob_log, jobs)
+
+circle_filter_pool = None
+
+def get_circle_filter_pool():
+    """Worker pool kept for the rest of the session."""
+    global circle_filter_pool
+    if circle_filter_pool is None:
+        circle_filter_pool = multiprocessing.Pool(processes=None,
+                                                  maxtasksperchild=None,
+                                                 )
+        atexit.register(close_circle_filter_pool)
+    return circle_filter_pool
+
+def close_circle_filter_pool():
+    global circle_filter_pool, shared_arrays
+    if circle_filter_pool is not None:
+        circle_filter_pool.close()
+        circle_filter_pool.join()
+        circle_filter_pool = None
+    for shm, view in shared_arrays.values():
+        del view
+        shm.close()
+        shm.unlink()
+    shared_arrays = {}
+
+def clip_basins_to_best_blobs(basins,
+                              per_basin_blobs,
+                              circle_scaling=1.5,
+                             ):
+    """
+    For each basin, pick the blob whose disk is darkest in the corrected
+    image and clip the basin to that blob's circle, scaled by
+    circle_scaling. Returns the clipped copy of basins.
+    """
+    global plate
+    #best_per_basin_blobs = {basin: max(blobs, key=lambda x:x[2])
+    #                        for basin, blobs
+    #                        in per_basin_blobs.iteritems()
+    #                       }
+    best_per_basin_blobs = {}
+    for basin, blobs in per_basin_blobs.items():
+        best_h, best_w, best_r, best_value = None, None, None, None
+        for blob in blobs:
+            h, w, r = blob
+            h, w, r = int(h), int(w), int(r)
+            circle_value = plate.disk_means(tag_in='corrected_rescaled_image',
+                                            radius=r,
+                                           )[h, w]
+            if best_value is None or circle_value < best_value:
+                best_h = h
+                best_w = w
+                best_r = r
+                best_value = circle_value
+        best_per_basin_blobs[basin] = (best_h, best_w, best_r)
+    image = plate.image_stash['corrected_rescaled_image']
+    updated_basins = basins.copy()
+    basin_slices = ndi.find_objects(basins)
+    for basin, (h, w, r) in best_per_basin_blobs.items():
+        circle = appaloosa.Plate.make_local_circle(image=image,
+                                                   h=h, w=w,
+                                                   radius=r*circle_scaling,
+                                                  )
+        appaloosa.Plate.clip_label_to_circle(
+                                             basins=updated_basins,
+                                             basin=basin,
+                                             circle=circle,
+                                             basin_slice=basin_slices[basin - 1],
+                                            )
     return updated_basins
 
-def circle_filter_all_button():
+def on_circle_filter_all():
     mode = 'isolated_LoG_MP'
     if mode == 'LoG':
         stdout.write("Applying circle filter to all basins...")
@@ -984,17 +1571,18 @@ def circle_filter_all_button():
                                   }
         circle_scaling = 1.5
         for basin, (h, w, r) in largest_per_basin_blobs.items():
-            boolean_circle_array = appaloosa.Plate.make_boolean_circle(
-                           image=plate.image_stash['corrected_rescaled_image'],
-                           h=h, w=w,
-                           radius=r,
-                                                                      )
+            disk_means = plate.disk_means(tag_in='corrected_rescaled_image',
+                                          radius=r*circle_scaling,
+                                         )
             updated_basins = circle_filter(image=plate.image_stash['corrected_rescaled_image'],
                                            basins=plate.feature_stash['iterated_basins'],
                                            basin=basin,
                                            radius=r*circle_scaling,
+                                           disk_means=disk_means,
                                           )
-            plate.feature_stash['iterated_basins'] = updated_basins
+            plate.update_basins(basins_feature='iterated_basins',
+                                basins=updated_basins,
+                               )
         remeasure_basins(plate)
         global tk_image, canvas, pil_image, canvas_image, resize_ratio
         color_image = plate.image_stash['rescaled_image']
@@ -1054,17 +1642,18 @@ def circle_filter_all_button():
                                   }
         circle_scaling = 1.5
         for basin, (h, w, r) in largest_per_basin_blobs.items():
-            boolean_circle_array = appaloosa.Plate.make_boolean_circle(
-                           image=plate.image_stash['corrected_rescaled_image'],
-                           h=h, w=w,
-                           radius=r,
-                                                                      )
+            disk_means = plate.disk_means(tag_in='corrected_rescaled_image',
+                                          radius=r*circle_scaling,
+                                         )
             updated_basins = circle_filter(image=plate.image_stash['corrected_rescaled_image'],
                                            basins=plate.feature_stash['iterated_basins'],
                                            basin=basin,
                                            radius=r*circle_scaling,
+                                           disk_means=disk_means,
                                           )
-            plate.feature_stash['iterated_basins'] = updated_basins
+            plate.update_basins(basins_feature='iterated_basins',
+                                basins=updated_basins,
+                               )
         remeasure_basins(plate)
         # global tk_image, canvas, pil_image, canvas_image, resize_ratio
         color_image = plate.image_stash['rescaled_image']
@@ -1082,111 +1671,39 @@ def circle_filter_all_button():
         stdout.flush()
         # global plate, circle_filter_entry
         max_radius = int(circle_filter_entry.get())
-        plate.image_stash['inverted_corrected_rescaled_image'] = \
+        # Kept across clicks so the cached blobs stay valid
+        if 'inverted_corrected_rescaled_image' not in plate.image_stash:
+            plate.image_stash['inverted_corrected_rescaled_image'] = \
                           invert(plate.image_stash['corrected_rescaled_image'])
         basins = plate.feature_stash['iterated_basins']
-        per_basin_blobs = defaultdict(list)
-        all_blobs = []
-        inverted_image_min = \
-                np.amin(plate.image_stash['inverted_corrected_rescaled_image'])
-        pool = multiprocessing.Pool(processes=None,
-                                    maxtasksperchild=None,
-                                   )
-        processes = []
-        for basin in iter(set(basins.reshape(-1))):
-            if basin == 0:
-                continue
-            plate.image_stash['isolated_image'] = np.where(
-                        basins == basin,
-                        plate.image_stash['inverted_corrected_rescaled_image'],
-                        inverted_image_min,
-                                                          )
-            isolated_image = plate.image_stash['isolated_image']
-            min_sigma = 5
-            max_sigma = max_radius
-            num_sigma = 10
-            threshold = 0.01
-            overlap = 0.5
-            process = pool.apply_async(blob_log,
-                                       (isolated_image,
-                                        min_sigma,
-                                        max_sigma,
-                                        num_sigma,
-                                        threshold,
-                                        overlap,
-                                       )
-                                      )
-            processes.append((basin, process))
-        pool.close()
-        pool.join()
-        for basin, process in processes:
-            blobs = process.get()
-            for blob in blobs:
-                h, w, r = blob
-                h, w, r = int(h), int(w), int(r)
-                per_basin_blobs[basin].append((h, w, r))
-                all_blobs.append((h, w, r))
-        plate.feature_stash['all_blobs'] = all_blobs
+        # Basins whose blobs are not cached are spread over the session pool
+        plate.find_basin_blobs(tag_in='inverted_corrected_rescaled_image',
+                               basins_feature='iterated_basins',
+                               feature_out='basin_blobs',
+                               min_sigma=5,
+                               max_sigma=max_radius,
+                               num_sigma=10,
+                               threshold=0.01,
+                               overlap=0.5,
+                               blob_finder=pooled_blob_finder,
+                              )
+        per_basin_blobs = plate.feature_stash['basin_blobs']
+        plate.feature_stash['all_blobs'] = [
+                                    (int(h), int(w), int(r))
+                                    for blobs in per_basin_blobs.values()
+                                    for h, w, r in blobs]
         #plate.display(tag_in='corrected_rescaled_image',
         #              figsize=20,
         #              blobs_feature='all_blobs',
         #              output_filename='ISOLATED_BLOBS.png',
         #             )
-        #best_per_basin_blobs = {basin: max(blobs, key=lambda x:x[2])
-        #                        for basin, blobs
-        #                        in per_basin_blobs.iteritems()
-        #                       }
-        best_per_basin_blobs = {}
-        for basin, blobs in per_basin_blobs.items():
-            best_h, best_w, best_r, best_value = None, None, None, None
-            for blob in blobs:
-                h, w, r = blob
-                h, w, r = int(h), int(w), int(r)
-                image = plate.image_stash['corrected_rescaled_image']
-                boolean_circle = make_boolean_circle(image=image,
-                                                     h=h, w=w,
-                                                     radius=r,
-                                                    )
-                circle_sum = np.sum(np.where(boolean_circle, image, 0))
-                circle_area = np.sum(np.where(boolean_circle, 1, 0))
-                circle_value = circle_sum / float(circle_area)
-                if best_value is None or circle_value < best_value:
-                    best_h = h
-                    best_w = w
-                    best_r = r
-                    best_value = circle_value
-            best_per_basin_blobs[basin] = (best_h, best_w, best_r)
-        circle_scaling = 1.5
-        pool = multiprocessing.Pool(processes=None,
-                                    maxtasksperchild=None,
-                                   )
-        processes = []
-        updated_basin_list = []
-        for basin, (h, w, r) in best_per_basin_blobs.items():
-            image = plate.image_stash['corrected_rescaled_image']
-            radius = r
-            process = pool.apply_async(make_boolean_circle,
-                                       (image,
-                                        h, w,
-                                        radius*circle_scaling,
-                                       )
-                                      )
-            processes.append((basin, process))
-        pool.close()
-        pool.join()
-        updated_basins = basins
-        for basin, process in processes:
-            boolean_circle_array = process.get()
-            logical_filter = np.where(
-                             (updated_basins == basin) & ~boolean_circle_array,
-                             False,
-                             True,
-                                     )
-            updated_basins = np.where(logical_filter,
-                                      updated_basins,
-                                      np.zeros_like(updated_basins),
-                                     )
-        plate.feature_stash['iterated_basins'] = updated_basins
+        updated_basins = clip_basins_to_best_blobs(
+                                               basins=basins,
+                                               per_basin_blobs=per_basin_blobs,
+                                                  )
+        plate.update_basins(basins_feature='iterated_basins',
+                            basins=updated_basins,
+                           )
         remeasure_basins(plate)
         # global tk_image, canvas, pil_image, canvas_image, resize_ratio
         color_image = plate.image_stash['rescaled_image']
@@ -1211,7 +1728,9 @@ def circle_filter_all_button():
                                            basins=basins,
                                            radius=radius,
                                           )
-        plate.feature_stash['iterated_basins'] = updated_basins
+        plate.update_basins(basins_feature='iterated_basins',
+                            basins=updated_basins,
+                           )
         remeasure_basins(plate)
         # global tk_image, canvas, pil_image, canvas_image, resize_ratio
         color_image = plate.image_stash['rescaled_image']
@@ -1274,58 +1793,28 @@ def keyboard(event):
         # global plate, circle_filter_entry
         if mode == 'isolated_LoG':
             max_radius = int(circle_filter_entry.get())
-            plate.image_stash['inverted_corrected_rescaled_image'] = \
+            # Kept across presses so the cached blobs stay valid
+            if 'inverted_corrected_rescaled_image' not in plate.image_stash:
+                plate.image_stash['inverted_corrected_rescaled_image'] = \
                           invert(plate.image_stash['corrected_rescaled_image'])
-            inverted_image_min = \
-                np.amin(plate.image_stash['inverted_corrected_rescaled_image'])
-            plate.image_stash['isolated_image'] = np.where(
-                        basins == basin,
-                        plate.image_stash['inverted_corrected_rescaled_image'],
-                        inverted_image_min,
-                                                          )
-            plate.find_blobs(tag_in='isolated_image',
-                             feature_out='isolated_blobs',
-                             min_sigma=5,
-                             max_sigma=max_radius,
-                             num_sigma=10,
-                             threshold=0.01,
-                             overlap=0.5,
-                            )
-            blobs = plate.feature_stash['isolated_blobs']
-            best_h, best_w, best_r, best_value = None, None, None, None
-            image = plate.image_stash['corrected_rescaled_image']
-            for blob in blobs:
-                h, w, r = blob
-                h, w, r = int(h), int(w), int(r)
-                boolean_circle = make_boolean_circle(image=image,
-                                                     h=h, w=w,
-                                                     radius=r,
-                                                    )
-                circle_sum = np.sum(np.where(boolean_circle, image, 0))
-                circle_area = np.sum(np.where(boolean_circle, 1, 0))
-                circle_value = circle_sum / float(circle_area)
-                if best_value is None or circle_value < best_value:
-                    best_h = h
-                    best_w = w
-                    best_r = r
-                    best_value = circle_value
-            circle_scaling = 1.5
-            boolean_circle_array = make_boolean_circle(
-                                                  image=image,
-                                                  h=best_h, w=best_w,
-                                                  radius=best_r*circle_scaling,
+            plate.find_basin_blobs(tag_in='inverted_corrected_rescaled_image',
+                                   basins_feature='iterated_basins',
+                                   feature_out='isolated_blobs',
+                                   min_sigma=5,
+                                   max_sigma=max_radius,
+                                   num_sigma=10,
+                                   threshold=0.01,
+                                   overlap=0.5,
+                                   labels=[basin],
+                                  )
+            updated_basins = clip_basins_to_best_blobs(
+                                basins=basins,
+                                per_basin_blobs=plate.feature_stash[
+                                                             'isolated_blobs'],
                                                       )
-            updated_basins = basins
-            logical_filter = np.where(
-                             (updated_basins == basin) & ~boolean_circle_array,
-                             False,
-                             True,
-                                     )
-            updated_basins = np.where(logical_filter,
-                                      updated_basins,
-                                      np.zeros_like(updated_basins),
-                                     )
-            plate.feature_stash['iterated_basins'] = updated_basins
+            plate.update_basins(basins_feature='iterated_basins',
+                                basins=updated_basins,
+                               )
         elif mode == 'manual':
             radius = int(circle_filter_entry.get())
             updated_basins = circle_filter(
@@ -1334,7 +1823,9 @@ def keyboard(event):
                            basin=basin,
                            radius=radius,
                                           )
-            plate.feature_stash['iterated_basins'] = updated_basins
+            plate.update_basins(basins_feature='iterated_basins',
+                                basins=updated_basins,
+                               )
         else:
             print("Unrecognized circle filter mode; ignoring.")
         remeasure_basins(plate)
@@ -1353,9 +1844,6 @@ def keyboard(event):
     else:
         pass
 
-
-canvas.bind('<Key>', keyboard)
-
 def add_basin():
     # global left_click_buffer, resize_ratio
     if len(left_click_buffer) < 2:
@@ -1373,22 +1861,27 @@ def add_basin():
     radius = euclidean((mapped_w1, mapped_h1), (mapped_w2, mapped_h2)) / 2.0
     # global plate
     basins = plate.feature_stash['iterated_basins']
-    largest_basins_tag = np.amax(basins)
+    largest_basins_tag = int(np.amax(basins))
     print(("largest_basins_tag = " + str(largest_basins_tag)))
     new_basin_tag = largest_basins_tag + 1
-    updated_basins = basins.copy()
-    #min_h, max_h = min(mapped_h1, mapped_h2), max(mapped_h1, mapped_h2)
-    #min_w, max_w = min(mapped_w1, mapped_w2), max(mapped_w1, mapped_w2)
-    min_h, max_h = center_h - radius, center_h + radius
-    min_w, max_w = center_w - radius, center_w + radius
-    for (h, w), basin in np.ndenumerate(basins):
-        if not (min_h <= h <= max_h and min_w <= w <= max_w):
-            continue
-        distance = euclidean((h, w), (center_h, center_w))
-        if distance > radius:
-            continue
-        updated_basins[h, w] = new_basin_tag
-    plate.feature_stash['iterated_basins'] = updated_basins
+    updated_basins = basins.astype(
+                     appaloosa.Plate.compact_label_dtype(new_basin_tag,
+                                                         basins.dtype,
+                                                        ),
+                                  )
+    changed_bbox = appaloosa.Plate.stamp_label(
+                        basins=updated_basins,
+                        label=new_basin_tag,
+                        coordinates=appaloosa.Plate.disk_coordinates(
+                                                  shape=basins.shape,
+                                                  center=(center_h, center_w),
+                                                  radius=radius,
+                                                                    ),
+                                              )
+    plate.update_basins(basins_feature='iterated_basins',
+                        basins=updated_basins,
+                        changed_bbox=changed_bbox,
+                       )
     remeasure_basins(plate)
     global tk_image, canvas, pil_image
     color_image = plate.image_stash['rescaled_image']
@@ -1396,18 +1889,13 @@ def add_basin():
                                basins=plate.feature_stash['iterated_basins'],
                                resize_ratio=resize_ratio,
                                assignment_feature='base_assignments',
+                               changed_bbox=changed_bbox,
                               )
     tk_image = ImageTk.PhotoImage(image=pil_image)
     canvas.itemconfig(canvas_image, image=tk_image)
     stdout.write("complete\n")
     stdout.flush()
 
-add_basin_button = tk.Button(bottom_frame,
-                             text="Add spot",
-                             command=add_basin,
-                            )
-add_basin_button.grid(column=7, row=1)
-
 def post_front():
     global plate
     solvent_front_line = plate.feature_stash.get('solvent_front', None)
@@ -1416,21 +1904,12 @@ def post_front():
         return
     (mapped_w1, mapped_h1), (mapped_w2, mapped_h2) = solvent_front_line
     basins = plate.feature_stash['iterated_basins']
-    split_plate = np.zeros_like(basins).astype(np.bool)
-    if mapped_h1 == mapped_h2:
-        for (h, w) in np.ndindex(*split_plate.shape):
-            if h > mapped_h1:
-                split_plate[h, w] = True
-    elif mapped_w1 == mapped_w2:
-        for (h, w) in np.ndindex(*split_plate.shape):
-            if w > mapped_w1:
-                split_plate[h, w] = True
-    else:
-        slope = float(mapped_w2 - mapped_w1) / (mapped_h2 - mapped_h1)
-        for (h, w) in np.ndindex(*split_plate.shape):
-            coord_value = slope * (h - mapped_h1) + mapped_w1
-            if coord_value > w:
-                split_plate[h, w] = True
+    split_plate = appaloosa.Plate.half_plane_mask(
+                                         shape=basins.shape,
+                                         line=((mapped_h1, mapped_w1),
+                                               (mapped_h2, mapped_w2)),
+                                         horizontal_first=True,
+                                                 )
     global left_click_buffer
     if len(left_click_buffer) < 1:
         print("No point defined; ignoring.")
@@ -1451,12 +1930,12 @@ def post_front():
         ich, icw = int(round(ch)), int(round(cw))
         if split_plate[ich, icw] == split_plate[mapped_h, mapped_w]:
             to_delete.append(basin)
-    for delete_basin in to_delete:
-        basins = np.where(basins == delete_basin,
-                          0,
-                          basins,
-                         )
-    plate.feature_stash['iterated_basins'] = basins
+    basins = appaloosa.Plate.relabel(basins=basins,
+                                     mapping={basin: 0 for basin in to_delete},
+                                    )
+    plate.update_basins(basins_feature='iterated_basins',
+                        basins=basins,
+                       )
     remeasure_basins(plate)
     global pil_image, tk_image, canvas
     color_image = plate.image_stash['rescaled_image']
@@ -1467,12 +1946,6 @@ def post_front():
     tk_image = ImageTk.PhotoImage(image=pil_image)
     canvas.itemconfig(canvas_image, image=tk_image)
 
-post_front_button = tk.Button(bottom_frame,
-                              text="Remove spots above front",
-                              command=post_front,
-                             )
-post_front_button.grid(column=3, row=1)
-
 pil_cache = None
 
 def overlay_original(event):
@@ -1496,25 +1969,217 @@ def unoverlay_original(event):
     tk_image = ImageTk.PhotoImage(image=pil_image)
     canvas.itemconfig(canvas_image, image=tk_image)
 
-show_original_button = tk.Button(bottom_frame,
-                                 text="Show original",
-                                )
-show_original_button.grid(column=1, row=3)
-show_original_button.bind('<ButtonPress-1>', overlay_original)
-show_original_button.bind('<ButtonRelease-1>', unoverlay_original)
+def main():
+    """
+    Segment the plates on the command line with --batch, or else one plate
+    in the interactive editor. The GUI state lives in module globals for the
+    callbacks above.
+    """
+    global Image, ImageTk, background_grid, base1_assign_button
+    global base2_assign_button, base3_assign_button, base4_assign_button
+    global canvas, canvas_image, circle_filter_entry, maxima_distance_entry
+    global pil_image, plate, resize_ratio, tk, tk_image
+    args = parser.parse_args()
+
+    if args.batch:
+        failures = run_batch(pattern=args.image_filename,
+                             output_dir=args.output_dir,
+                             workers=args.workers,
+                             intermediate_images=args.intermediate_images,
+                             cache_dir=args.cache_dir,
+                             profile=args.profile,
+                             stash_budget=args.stash_budget,
+                             spill_dir=args.spill_dir,
+                             fast_crop=args.fast_crop,
+                             median_method=args.median_method,
+                             reuse_background=not args.recompute_background,
+                            )
+        sys.exit(1 if failures else 0)
+
+    #We use Tkinter for GUI
+    import tkinter as tk
+    from PIL import Image, ImageTk
+
+    plate = segment_plate(image_filename=args.image_filename,
+                          intermediate_images=args.intermediate_images,
+                          cache_dir=args.cache_dir,
+                          profile=args.profile,
+                          stash_budget=args.stash_budget,
+                          spill_dir=args.spill_dir,
+                          fast_crop=args.fast_crop,
+                          median_method=args.median_method,
+                          reuse_background=not args.recompute_background,
+                         )
+
+    # Display basins in GUI and begin interactive segmentation
+    #Edits build new label images, so the two tags can share memory
+    plate.feature_stash['iterated_basins'] = appaloosa.Plate.read_only(
+                            plate.feature_stash['overlaid_watershed_basins'],
+                                                                      )
+    #Take the measurements on these same labels now, so edits can be remeasured
+    #incrementally from here
+    plate.feature_stash['basin_intensities']
+    plate.feature_stash['basin_centroids']
+    plate.pop_label_changes('iterated_basins')
+
+    resize_ratio = args.zoom
 
-circle_filter_label = tk.Label(bottom_frame,
-                               text="Circle filter sigma",
+    background_grid = np.zeros_like(plate.feature_stash['iterated_basins'])
+    background_grid[::grid_spacing, ::grid_spacing] = 1
+
+    root = tk.Tk()
+    color_image = plate.image_stash['rescaled_image']
+    pil_image = make_pil_image(color_image=color_image,
+                               basins=plate.feature_stash['iterated_basins'],
+                               resize_ratio=resize_ratio,
                               )
-circle_filter_label.grid(column=3, row=3)
-circle_filter_entry = tk.Entry(bottom_frame)
-circle_filter_entry.insert(0, 10)
-circle_filter_entry.grid(column=4, row=3)
-
-circle_filter_all_button = tk.Button(bottom_frame,
-                                     text="Circle filter all",
-                                     command=circle_filter_all_button,
+    frame = tk.Frame(root,width=500,height=500)
+    frame.pack(expand=True, fill=tk.BOTH)
+    tk_image = ImageTk.PhotoImage(master=frame,
+                                  image=pil_image,
+                                 )
+    image_width, image_height = pil_image.size
+    canvas = tk.Canvas(frame,
+                       width=500,
+                       height=500,
+                       scrollregion=(0,0,image_width,image_height)
+                      )
+    hbar=tk.Scrollbar(frame,orient=tk.HORIZONTAL)
+    hbar.pack(side=tk.BOTTOM,fill=tk.X)
+    hbar.config(command=canvas.xview)
+    vbar=tk.Scrollbar(frame,orient=tk.VERTICAL)
+    vbar.pack(side=tk.RIGHT,fill=tk.Y)
+    vbar.config(command=canvas.yview)
+    canvas.config(width=500,height=500)
+    canvas.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
+    canvas.pack(side=tk.LEFT,expand=True,fill=tk.BOTH)
+    canvas_image = canvas.create_image(0, 0,
+                                       anchor='nw',
+                                       image=tk_image,
+                                      )
+    bottom_frame = tk.Frame(root)
+    bottom_frame.pack(side=tk.BOTTOM)
+    quit_button = tk.Button(bottom_frame,
+                            text="Quit",
+                            command=quit,
+                           )
+    quit_button.grid(column=0, row=1)
+
+    save_button = tk.Button(bottom_frame,
+                            text="Save & Quit",
+                            command=on_save,
+                           )
+    save_button.grid(column=1, row=1)
+
+    alive_button = tk.Button(bottom_frame,
+                             text="Alive?",
+                             command=alive,
+                            )
+    alive_button.grid(column=8, row=1)
+
+    maxima_distance_label = tk.Label(bottom_frame,
+                                     text="Subdivision resolution",
+                                    )
+    maxima_distance_label.grid(column=0, row=2)
+    maxima_distance_entry = tk.Entry(bottom_frame)
+    maxima_distance_entry.insert(0, 2)
+    maxima_distance_entry.grid(column=1, row=2)
+
+    canvas.bind('<Button 3>', right_click)
+
+    linear_split_button = tk.Button(bottom_frame,
+                                    text="Watershed subdivide spot",
+                                    command=subdivide_spot,
+                                   )
+    linear_split_button.grid(column=3, row=2)
+
+    canvas.bind('<Button 1>', left_click)
+
+
+    linear_split_button = tk.Button(bottom_frame,
+                                    text="Linear split",
+                                    command=linear_split,
+                                   )
+    linear_split_button.grid(column=4, row=1)
+
+    solvent_front_button = tk.Button(bottom_frame,
+                                     text="Solvent front",
+                                     command=solvent,
+                                    )
+    solvent_front_button.grid(column=5, row=1)
+
+    baseline_button = tk.Button(bottom_frame,
+                                text="Add baseline",
+                                command=add_baseline,
+                               )
+    baseline_button.grid(column=6, row=1)
+
+    base1_assign_button = tk.Button(bottom_frame,
+                                    text="1",
+                                    command=base1_assign,
+                                   )
+    base1_assign_button.grid(column=4, row=2)
+
+    base2_assign_button = tk.Button(bottom_frame,
+                                    text="2",
+                                    command=base2_assign,
+                                    )
+    base2_assign_button.grid(column=5, row=2)
+
+    base3_assign_button = tk.Button(bottom_frame,
+                                    text="3",
+                                    command=base3_assign,
+                                   )
+    base3_assign_button.grid(column=6, row=2)
+
+    base4_assign_button = tk.Button(bottom_frame,
+                                    text="4",
+                                    command=base4_assign,
+                                   )
+    base4_assign_button.grid(column=7, row=2)
+
+    canvas.bind('<Double-Button-1>', assign)
+
+    canvas.focus_set()
+
+
+    canvas.bind('<Key>', keyboard)
+
+    add_basin_button = tk.Button(bottom_frame,
+                                 text="Add spot",
+                                 command=add_basin,
+                                )
+    add_basin_button.grid(column=7, row=1)
+
+    post_front_button = tk.Button(bottom_frame,
+                                  text="Remove spots above front",
+                                  command=post_front,
+                                 )
+    post_front_button.grid(column=3, row=1)
+
+    show_original_button = tk.Button(bottom_frame,
+                                     text="Show original",
                                     )
-circle_filter_all_button.grid(column=5, row=3)
+    show_original_button.grid(column=1, row=3)
+    show_original_button.bind('<ButtonPress-1>', overlay_original)
+    show_original_button.bind('<ButtonRelease-1>', unoverlay_original)
+
+    circle_filter_label = tk.Label(bottom_frame,
+                                   text="Circle filter sigma",
+                                  )
+    circle_filter_label.grid(column=3, row=3)
+    circle_filter_entry = tk.Entry(bottom_frame)
+    circle_filter_entry.insert(0, 10)
+    circle_filter_entry.grid(column=4, row=3)
+
+    circle_filter_all_button = tk.Button(bottom_frame,
+                                         text="Circle filter all",
+                                         command=on_circle_filter_all,
+                                        )
+    circle_filter_all_button.grid(column=5, row=3)
+
+    root.mainloop()
+
 
-root.mainloop()
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,18 @@
 
-from collections import defaultdict
+import csv
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import tracemalloc
+import weakref
+from collections import defaultdict, OrderedDict
+from glob import glob
 from math import pi, degrees, radians, atan2, sqrt, log, acos
 from random import (uniform,
                     sample,
@@ -12,7 +25,7 @@ from itertools import tee, product, combinations_with_replacement
 import numpy as np
 from scipy import ndimage as ndi
 from scipy.misc import imread
-from scipy.signal import find_peaks_cwt
+from scipy.signal import find_peaks_cwt, fftconvolve
 from scipy.spatial.distance import euclidean, pdist
 from scipy.ndimage.interpolation import rotate
 from scipy.ndimage.filters import median_filter, gaussian_filter1d
@@ -49,6 +62,7 @@ from skimage.filters import (threshold_otsu,
                              sobel,
                              threshold_local,
                              median,
+                             rank,
                             )
 from skimage.util import invert
 from sklearn.cluster import KMeans
@@ -89,17 +103,659 @@ def epoch_to_hash(epoch):
     return epoch_hash
 
 
+def cached_stage(stage):
+    """
+    Decorator for Plate stage methods. When the Plate has a cache_dir, the
+    stash entries a stage writes are stored on disk under a key built from
+    the stage name, its parameters and the contents of its input tags
+    (tag_in, *_tag and *_feature arguments). A later call with the same key
+    restores them instead of running the stage.
+    """
+    signature = inspect.signature(stage)
+    @functools.wraps(stage)
+    def cached(self, *args, **kwargs):
+        if self.cache_dir is None:
+            return stage(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        del params['self']
+        key = self.stage_key(stage_name=stage.__name__, params=params)
+        restored = self.load_stage(key)
+        if restored is not None:
+            return restored
+        image_before = self.image_stash.versions.copy()
+        feature_before = self.feature_stash.versions.copy()
+        result = stage(self, *args, **kwargs)
+        self.save_stage(key=key,
+                        image_before=image_before,
+                        feature_before=feature_before,
+                        result=result,
+                       )
+        return result
+    return cached
+
+
+def profiled_stage(stage):
+    """
+    Decorator for Plate stage methods. When the Plate was created with
+    profile=True, each call appends a record of its wall time, CPU time,
+    peak traced memory and the sizes of the stash entries it wrote to
+    Plate.stage_profile.
+    """
+    @functools.wraps(stage)
+    def profiled(self, *args, **kwargs):
+        if self.stage_profile is None:
+            return stage(self, *args, **kwargs)
+        image_before = self.image_stash.versions.copy()
+        feature_before = self.feature_stash.versions.copy()
+        #Nested stages cannot reset the enclosing stage's peak, so only the
+        #outermost traced stage reports one
+        start_tracing = not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            result = stage(self, *args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            if start_tracing:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                peak_memory = None
+        outputs = {stash_name + '/' + tag: (value.nbytes
+                                            if isinstance(value, np.ndarray)
+                                            else None)
+                   for stash_name, tag, value
+                   in self.changed_entries(image_before=image_before,
+                                           feature_before=feature_before,
+                                          )}
+        self.stage_profile.append({'stage': stage.__name__,
+                                   'wall_time': wall_time,
+                                   'cpu_time': cpu_time,
+                                   'peak_memory': peak_memory,
+                                   'output_bytes': sum(nbytes for nbytes
+                                                       in outputs.values()
+                                                       if nbytes is not None),
+                                   'outputs': outputs,
+                                  })
+        return result
+    return profiled
+
+
+def stage_outputs(image_params=(), feature_params=()):
+    """
+    Decorator declaring which parameters of a Plate stage method name the
+    image_stash and feature_stash tags it writes, so that Plate.define_stage
+    can place the stage in the stage graph. Apply it beneath profiled_stage
+    and cached_stage.
+    """
+    def declare(stage):
+        stage.image_outputs = tuple(image_params)
+        stage.feature_outputs = tuple(feature_params)
+        return stage
+    return declare
+
+
+class Stash(dict):
+    """
+    dict for Plate.image_stash and Plate.feature_stash. Reading a missing tag
+    that a stage has been defined for (Plate.define_stage) runs the stage
+    first, and reassigning a tag drops the stored outputs of defined stages
+    that read it, so they are recomputed when next read. Membership tests and
+    get() only see entries that have been computed. versions numbers each
+    entry by the assignment that stored it, for Plate.changed_entries.
+    """
+    def __init__(self):
+        super(Stash, self).__init__()
+        self.plate = None
+        self.stash_name = None
+        self.versions = {}
+        self.last_version = 0
+
+    def attach(self, plate, stash_name):
+        self.plate = weakref.ref(plate)
+        self.stash_name = stash_name
+
+    def owner(self):
+        return None if self.plate is None else self.plate()
+
+    def __missing__(self, tag):
+        plate = self.owner()
+        if (plate is not None
+            and plate.produce(self.stash_name, tag)
+            and tag in self
+           ):
+            return self[tag]
+        raise KeyError(tag)
+
+    def __setitem__(self, tag, value):
+        dict.__setitem__(self, tag, value)
+        self.last_version += 1
+        self.versions[tag] = self.last_version
+        plate = self.owner()
+        if plate is not None:
+            plate.invalidate_dependents(self.stash_name, tag)
+
+
+class SpillingStash(Stash):
+    """
+    Stash for Plate.image_stash that keeps the numpy arrays it holds in memory
+    within memory_budget bytes. When an assignment takes it over budget, the
+    least recently used arrays are written to .npy files in a scratch
+    directory under spill_dir and replaced by copy-on-write np.memmap views
+    of those files, which read back from disk on access and otherwise behave
+    like the arrays they replace. A spilled entry keeps returning the same
+    memmap until it is reassigned. Spill files are removed when their entry
+    is replaced or deleted, and the scratch directory when the stash is
+    garbage collected.
+    """
+    def __init__(self,
+                 memory_budget,
+                 spill_dir=None,
+                ):
+        super(SpillingStash, self).__init__()
+        self.memory_budget = memory_budget
+        self.scratch_dir = tempfile.mkdtemp(prefix='appaloosa_stash_',
+                                            dir=spill_dir,
+                                           )
+        #tag -> nbytes of in-memory arrays, least recently used first
+        self.recency = OrderedDict()
+        self.spill_files = {}
+        self.finalizer = weakref.finalize(self,
+                                          shutil.rmtree,
+                                          self.scratch_dir,
+                                          True,
+                                         )
+
+    def __getitem__(self, tag):
+        value = dict.__getitem__(self, tag)
+        if tag in self.recency:
+            self.recency.move_to_end(tag)
+        return value
+
+    def __setitem__(self, tag, value):
+        self.recency.pop(tag, None)
+        self.remove_spill_file(tag)
+        Stash.__setitem__(self, tag, value)
+        if (isinstance(value, np.ndarray)
+            and not isinstance(value, np.memmap)
+            and not value.dtype.hasobject
+            and value.size > 0
+           ):
+            self.recency[tag] = value.nbytes
+            self.spill()
+
+    def __delitem__(self, tag):
+        dict.__delitem__(self, tag)
+        self.recency.pop(tag, None)
+        self.remove_spill_file(tag)
+
+    def remove_spill_file(self, tag):
+        path = self.spill_files.pop(tag, None)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def memory_bytes(self):
+        return sum(self.recency.values())
+
+    def spill(self):
+        """Spill least recently used arrays until within memory_budget."""
+        in_memory = self.memory_bytes()
+        while in_memory > self.memory_budget and self.recency:
+            tag, nbytes = self.recency.popitem(last=False)
+            value = dict.__getitem__(self, tag)
+            file_descriptor, path = tempfile.mkstemp(suffix='.npy',
+                                                     dir=self.scratch_dir,
+                                                    )
+            os.close(file_descriptor)
+            spill_file = np.lib.format.open_memmap(path,
+                                                   mode='w+',
+                                                   dtype=value.dtype,
+                                                   shape=value.shape,
+                                                  )
+            spill_file[...] = value
+            spill_file.flush()
+            del spill_file
+            spilled_value = np.load(path, mmap_mode='c')
+            dict.__setitem__(self, tag, spilled_value)
+            self.spill_files[tag] = path
+            plate = self.owner()
+            if plate is not None:
+                plate.release_spilled(self.stash_name,
+                                      tag,
+                                      value,
+                                      spilled_value,
+                                     )
+            del value
+            in_memory -= nbytes
+
+
 class Plate(object):
     def __init__(self,
                  image,
                  tag_in='original_image',
                  source_filename=None,
+                 cache_dir=None,
+                 cache_max_bytes=2 * 1024**3,
+                 profile=False,
+                 label_dtype=np.uint16,
+                 stash_memory_budget=None,
+                 spill_dir=None,
+                 copy_image=True,
                 ):
-        self.image_stash = {tag_in: image.copy()}
-        self.feature_stash = {}
+        """
+        cache_dir: directory for the on-disk stage cache (see cached_stage);
+                   None disables caching.
+        cache_max_bytes: the least recently used cache files are evicted
+                         once the directory grows past this size; None
+                         never evicts.
+        profile: record per-stage timing and memory in stage_profile (see
+                 profiled_stage).
+        label_dtype: dtype label images are stored as, promoted to uint32 or
+                     int64 when a plate has more labels than it holds (see
+                     compact_labels); None stores them as produced.
+        stash_memory_budget: bytes of image_stash arrays kept in memory;
+                             beyond it the least recently used are spilled
+                             to memory-mapped files (see SpillingStash).
+                             None keeps everything in memory.
+        spill_dir: where the spill files' scratch directory is created;
+                   defaults to the system temporary directory.
+        copy_image: stash a private copy of image. False hands image over
+                    to the plate instead, which stashes a read-only view of
+                    it; the caller must not modify it afterwards.
+        """
+        if stash_memory_budget is None:
+            self.image_stash = Stash()
+        else:
+            self.image_stash = SpillingStash(memory_budget=stash_memory_budget,
+                                             spill_dir=spill_dir,
+                                            )
+        self.feature_stash = Stash()
+        #(stash_name, tag) -> (stage_name, params, inputs, outputs)
+        self.stage_graph = {}
+        self.producing = set()
+        #(tag, color_space) -> image_stash[tag] converted (see stash_view)
+        self.view_cache = {}
+        self.disk_mean_cache = {}
+        self.basin_blob_cache = {}
+        self.hash_cache = {}
+        self.image_stash.attach(self, 'image_stash')
+        self.feature_stash.attach(self, 'feature_stash')
+        if copy_image:
+            self.image_stash[tag_in] = image.copy()
+        else:
+            self.image_stash[tag_in] = Plate.read_only(image)
         self.metadata = {'source_filename': source_filename}
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.stage_profile = [] if profile else None
+        self.label_dtype = label_dtype
+        self.label_changes = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    cache_version = '2'
+
+    @staticmethod
+    def content_hash(value):
+        digest = hashlib.sha1()
+        if isinstance(value, np.ndarray):
+            digest.update(str((value.dtype.str, value.shape)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+        else:
+            digest.update(pickle.dumps(value, protocol=2))
+        return digest.hexdigest()
+
+    def stash_hash(self, stash_name, tag):
+        """
+        Plate.content_hash of a stash entry, recomputed only if the entry
+        is replaced.
+        """
+        value = getattr(self, stash_name)[tag]
+        cached_value, digest = self.hash_cache.get((stash_name, tag),
+                                                   (None, None),
+                                                  )
+        if cached_value is not value:
+            digest = Plate.content_hash(value)
+            self.hash_cache[(stash_name, tag)] = (value, digest)
+        return digest
+
+    @staticmethod
+    def param_stash(name):
+        """
+        Which stash a stage parameter names a tag in: image_stash for tag_in
+        and *_tag, feature_stash for *_feature, otherwise None.
+        """
+        if name == 'tag_in' or name.endswith('_tag'):
+            return 'image_stash'
+        elif name.endswith('_feature'):
+            return 'feature_stash'
+        else:
+            return None
+
+    @staticmethod
+    def stage_inputs(params):
+        """(stash_name, tag) of every stash entry a stage's params read."""
+        inputs = []
+        for name, value in sorted(params.items()):
+            stash_name = Plate.param_stash(name)
+            if stash_name is not None and value is not None:
+                inputs.append((stash_name, value))
+        return tuple(inputs)
+
+    def define_stage(self, stage_name, **params):
+        """
+        Define the stash entries that stage stage_name writes (see
+        stage_outputs) as computed lazily: rather than running now, the stage
+        runs with these params the first time one of its outputs is read
+        from image_stash or feature_stash. Its inputs may themselves be
+        defined this way. Assigning a new value to an input drops the
+        computed outputs of every stage downstream of it, as does redefining
+        an output with different params.
+        """
+        stage = getattr(self, stage_name)
+        bound = inspect.signature(stage).bind(**params)
+        bound.apply_defaults()
+        params = dict(bound.arguments)
+        outputs = tuple(
+            [('image_stash', params[name])
+             for name in getattr(stage, 'image_outputs', ())
+             if params[name] is not None]
+            + [('feature_stash', params[name])
+               for name in getattr(stage, 'feature_outputs', ())
+               if params[name] is not None]
+                       )
+        if not outputs:
+            raise ValueError(stage_name + " declares no stash outputs.")
+        inputs = Plate.stage_inputs(params)
+        if set(inputs) & set(outputs):
+            raise ValueError(stage_name + " cannot be defined to read and "
+                             "write the same stash entry."
+                            )
+        recipe = (stage_name, params, inputs, outputs)
+        for stash_name, tag in outputs:
+            previous = self.stage_graph.get((stash_name, tag))
+            self.stage_graph[(stash_name, tag)] = recipe
+            if (previous is not None
+                and previous[0] == stage_name
+                and repr(sorted(previous[1].items()))
+                    == repr(sorted(params.items()))
+               ):
+                continue
+            stash = getattr(self, stash_name)
+            if tag in stash:
+                del stash[tag]
+            self.invalidate_dependents(stash_name, tag)
+
+    def produce(self, stash_name, tag):
+        """
+        Run the stage defined for a stash entry (see define_stage), first
+        producing those of its inputs that are defined but not yet computed.
+        Returns False if no stage is defined for the entry.
+        """
+        recipe = self.stage_graph.get((stash_name, tag))
+        if recipe is None:
+            return False
+        stage_name, params, inputs, outputs = recipe
+        if (stash_name, tag) in self.producing:
+            raise ValueError("Stage graph cycle through " + tag + ".")
+        self.producing.update(outputs)
+        try:
+            for input_stash, input_tag in inputs:
+                getattr(self, input_stash)[input_tag]
+            getattr(self, stage_name)(**params)
+        finally:
+            self.producing.difference_update(outputs)
+        return True
+
+    def invalidate_dependents(self,
+                              stash_name,
+                              tag,
+                              visited=None,
+                             ):
+        """
+        Drop the color views (see stash_view) of a stash entry and the
+        computed outputs of the defined stages downstream of it, so they are
+        recomputed from its new value when read.
+        """
+        if stash_name == 'image_stash':
+            self.drop_views(tag)
+        if visited is None:
+            visited = set()
+        for output, recipe in list(self.stage_graph.items()):
+            if output in visited or (stash_name, tag) not in recipe[2]:
+                continue
+            visited.add(output)
+            output_stash, output_tag = output
+            stash = getattr(self, output_stash)
+            if output_tag in stash:
+                del stash[output_tag]
+            self.invalidate_dependents(output_stash, output_tag, visited)
+
+    @staticmethod
+    def read_only(array):
+        """
+        A view of array that cannot be written through. Stages stash these
+        in place of copies when an entry shares memory with another entry
+        or the caller; code that edits such an entry must copy it first,
+        as the basin editing helpers do.
+        """
+        view = array.view()
+        view.flags.writeable = False
+        return view
 
+    @staticmethod
+    def convert_color(image, color_space):
+        """
+        image converted from RGB to color_space: 'gray', 'rgb' (unchanged),
+        'lab', 'hsv', 'XYZ', 'xyY' or 'luv'.
+        """
+        if color_space == 'gray':
+            return rgb2gray(image)
+        elif color_space == 'rgb':
+            return image
+        elif color_space == 'lab':
+            return rgb2lab(image)
+        elif color_space == 'hsv':
+            return rgb2hsv(image)
+        elif color_space == 'XYZ':
+            return rgb2xyz(image)
+        elif color_space == 'xyY':
+            return Plate.XYZ2xyY(rgb2xyz(image))
+        elif color_space == 'luv':
+            return rgb2luv(image)
+        else:
+            raise ValueError("Invalid color space.")
 
+    def stash_view(self, tag, color_space='gray'):
+        """
+        image_stash[tag] converted to color_space (see convert_color),
+        computed once and kept until the entry is reassigned. Callers must
+        not modify the returned array.
+        """
+        if (tag, color_space) not in self.view_cache:
+            self.view_cache[(tag, color_space)] = Plate.convert_color(
+                                                 image=self.image_stash[tag],
+                                                 color_space=color_space,
+                                                                     )
+        return self.view_cache[(tag, color_space)]
+
+    def release_spilled(self,
+                        stash_name,
+                        tag,
+                        value,
+                        spilled_value,
+                       ):
+        """
+        Point the caches that remember a stash entry by identity at the
+        memmap that replaced it when it was spilled (see SpillingStash), so
+        they stop holding the in-memory array, and drop its color views.
+        """
+        cached_value, digest = self.hash_cache.get((stash_name, tag),
+                                                   (None, None),
+                                                  )
+        if cached_value is value:
+            self.hash_cache[(stash_name, tag)] = (spilled_value, digest)
+        if stash_name != 'image_stash':
+            return
+        self.drop_views(tag)
+        for cache in (self.disk_mean_cache, self.basin_blob_cache):
+            for key, (cached_image, result) in list(cache.items()):
+                if key[0] == tag and cached_image is value:
+                    cache[key] = (spilled_value, result)
+
+    def drop_views(self, tag):
+        for key in [key for key in self.view_cache if key[0] == tag]:
+            del self.view_cache[key]
+
+    def stage_key(self, stage_name, params):
+        digest = hashlib.sha1()
+        digest.update((Plate.cache_version + stage_name).encode())
+        label_dtype = (None if self.label_dtype is None
+                       else np.dtype(self.label_dtype).str)
+        digest.update(('label_dtype=' + repr(label_dtype) + ';').encode())
+        for name, value in sorted(params.items()):
+            digest.update((name + '=' + repr(value) + ';').encode())
+            stash_name = Plate.param_stash(name)
+            if stash_name is None or value is None:
+                continue
+            if (value in getattr(self, stash_name)
+                or (stash_name, value) in self.stage_graph
+               ):
+                digest.update(self.stash_hash(stash_name, value).encode())
+        return digest.hexdigest()
+
+    def changed_entries(self,
+                        image_before,
+                        feature_before,
+                       ):
+        """
+        (stash_name, tag, value) for every stash entry added or replaced
+        since the image_before/feature_before snapshots of the stashes'
+        versions were taken. Spilling an entry (see SpillingStash) does not
+        count as replacing it.
+        """
+        changed = []
+        for stash_name, before in (('image_stash', image_before),
+                                   ('feature_stash', feature_before),
+                                  ):
+            stash = getattr(self, stash_name)
+            for tag, value in stash.items():
+                if before.get(tag) == stash.versions[tag]:
+                    continue
+                changed.append((stash_name, tag, value))
+        return changed
+
+    def save_profile_json(self, filename):
+        with open(filename, 'w') as json_file:
+            json.dump(self.stage_profile, json_file, indent=1)
+
+    def save_profile_csv(self, filename):
+        with open(filename, 'w') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_header = ["stage", "wall_time", "cpu_time", "peak_memory",
+                          "output_bytes", "outputs"]
+            csv_writer.writerow(csv_header)
+            for record in self.stage_profile:
+                outputs = ';'.join(tag + '=' + str(nbytes)
+                                   for tag, nbytes
+                                   in sorted(record['outputs'].items()))
+                csv_writer.writerow([record[column]
+                                     for column in csv_header[:-1]]
+                                    + [outputs])
+
+    def stage_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def save_stage(self,
+                   key,
+                   image_before,
+                   feature_before,
+                   result,
+                  ):
+        entries, manifest = {}, []
+        for stash_name, tag, value in self.changed_entries(
+                                                 image_before=image_before,
+                                                 feature_before=feature_before,
+                                                          ):
+            entry_name = 'entry_' + str(len(manifest))
+            is_array = isinstance(value, np.ndarray)
+            if is_array:
+                entries[entry_name] = value
+            else:
+                entries[entry_name] = np.empty((), dtype=object)
+                entries[entry_name][()] = value
+            manifest.append((stash_name, tag, entry_name, is_array))
+        #Stage results are stash entries (or None); record which ones
+        result_spec = []
+        for item in result:
+            matches = [(stash_name, tag)
+                       for stash_name, tag, entry_name, is_array in manifest
+                       if getattr(self, stash_name)[tag] is item]
+            result_spec.append(matches[0] if matches else None)
+        metadata = np.empty((), dtype=object)
+        metadata[()] = (manifest, result_spec)
+        entries['metadata'] = metadata
+        #Write atomically so concurrent batch workers never see partial files
+        file_handle, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                                  suffix='.tmp',
+                                                 )
+        with os.fdopen(file_handle, 'wb') as temp_file:
+            np.savez_compressed(temp_file, **entries)
+        os.replace(temp_path, self.stage_path(key))
+        self.evict_cache()
+
+    def load_stage(self, key):
+        path = self.stage_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=True) as data:
+                manifest, result_spec = data['metadata'][()]
+                loaded = [(stash_name, tag, (data[entry_name] if is_array
+                                             else data[entry_name][()]))
+                          for stash_name, tag, entry_name, is_array
+                          in manifest]
+        except (IOError, OSError, ValueError, KeyError, EOFError):
+            return None
+        for stash_name, tag, value in loaded:
+            getattr(self, stash_name)[tag] = value
+        #Mark as recently used for eviction
+        os.utime(path, None)
+        result = tuple(None if spec is None
+                       else getattr(self, spec[0])[spec[1]]
+                       for spec in result_spec)
+        return result
+
+    def evict_cache(self):
+        if self.cache_max_bytes is None:
+            return
+        cache_files = []
+        for path in glob(os.path.join(self.cache_dir, '*.npz')):
+            try:
+                path_stat = os.stat(path)
+            except OSError:
+                continue
+            cache_files.append((path_stat.st_mtime, path_stat.st_size, path))
+        total_bytes = sum(size for mtime, size, path in cache_files)
+        for mtime, size, path in sorted(cache_files):
+            if total_bytes <= self.cache_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(image_params=('tag_out',),
+                   feature_params=('feature_out',),
+                  )
     def crop_to_plate(self,
                       tag_in,
                       tag_out,
@@ -107,6 +763,7 @@ class Plate(object):
                       second_pass=True,
                      ):
         image = self.image_stash[tag_in]
+        #One-shot conversion of the full resolution input, not worth keeping
         g_img = rgb2gray(image)
         t_img = (g_img > threshold_otsu(g_img)).astype(np.uint8)
         labels, num_labels = (ndi
@@ -147,6 +804,124 @@ class Plate(object):
         self.feature_stash[feature_out] = rotation
         return self.image_stash[tag_out], self.feature_stash[feature_out]
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(image_params=('tag_out',),
+                   feature_params=('feature_out',),
+                  )
+    def fast_crop_to_plate(self,
+                           tag_in,
+                           tag_out,
+                           feature_out='crop_rotation',
+                           target_scale=500,
+                           border_fraction=0.03,
+                           mask_dimension=1000,
+                           order=1,
+                          ):
+        """
+        Fast stand-in for crop_to_plate (without second_pass), crop_border
+        and rescale_image run one after the other, for large photographs.
+        The plate and its orientation are found on a mask thresholded from
+        the image subsampled to at most mask_dimension pixels a side. The
+        plate's bounding box is box-filtered down to within a factor of two
+        of the target resolution, and a single affine warp of spline order
+        order then rotates it, trims border_fraction of the rotated plate's
+        smaller dimension from each side and scales it so that its larger
+        dimension is target_scale pixels. Like rescale_image, the result is
+        a float image.
+        """
+        image = self.image_stash[tag_in]
+        image_height, image_width = image.shape[:2]
+        step = max(1, int(np.ceil(float(max(image_height, image_width))
+                                  / mask_dimension)))
+        g_img = rgb2gray(image[::step, ::step])
+        t_img = (g_img > threshold_otsu(g_img)).astype(np.uint8)
+        labels, num_labels = (ndi
+                              .measurements
+                              .label(ndi.binary_fill_holes(t_img))
+                             )
+        objects = ndi.measurements.find_objects(labels)
+        h_slice, w_slice = max(objects,
+                               key=lambda x:g_img[x].size,
+                              )
+        rp = regionprops(t_img,
+                         intensity_image=t_img,
+                         coordinates='xy',
+                        )
+        assert len(rp) == 1
+        rads = rp[0].orientation
+        rads %= 2 * pi
+        rotation = 90 - degrees(rads)
+        #Plate bounding box at full resolution
+        h1, h2 = h_slice.start * step, min(image_height, h_slice.stop * step)
+        w1, w2 = w_slice.start * step, min(image_width, w_slice.stop * step)
+        plate_shape = np.array((h2 - h1, w2 - w1))
+        #Rotation about the box's center, as in ndi.rotate with reshape=True
+        c, s = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+        rotation_matrix = np.array([[c, s], [-s, c]])
+        bounds = np.dot(rotation_matrix,
+                        [[0, 0, plate_shape[0], plate_shape[0]],
+                         [0, plate_shape[1], 0, plate_shape[1]]],
+                       )
+        rotated_shape = (np.ptp(bounds, axis=1) + 0.5).astype(int)
+        border = int(round(min(rotated_shape) * border_fraction))
+        bordered_shape = rotated_shape - 2 * border
+        if min(bordered_shape) < 1:
+            raise ValueError("Cannot crop to image with 0 pixels.")
+        scaling_factor = float(target_scale) / max(bordered_shape)
+        output_shape = np.maximum(np.round(bordered_shape * scaling_factor),
+                                  1,
+                                 ).astype(int)
+        #Box filter the plate down to the nearest integer factor above the
+        #target resolution
+        block = max(1, int(1.0 / scaling_factor))
+        block_shape = plate_shape // block
+        plate_image = image[h1:h1 + block_shape[0] * block,
+                            w1:w1 + block_shape[1] * block]
+        if plate_image.ndim == 2:
+            plate_image = plate_image[..., np.newaxis]
+        channels = plate_image.shape[2]
+        blocks = plate_image.reshape(block_shape[0], block,
+                                     block_shape[1], block,
+                                     channels,
+                                    ).mean(axis=(1, 3))
+        if np.issubdtype(image.dtype, np.integer):
+            blocks /= np.iinfo(image.dtype).max
+        #Output pixel -> bordered pixel -> rotated pixel -> plate pixel ->
+        #block pixel, composed into one affine map
+        output_to_bordered = bordered_shape / output_shape.astype(float)
+        matrix = (rotation_matrix * output_to_bordered) / block
+        offset = (np.dot(rotation_matrix,
+                         0.5 * output_to_bordered - 0.5 + border
+                         - (rotated_shape - 1) / 2.0,
+                        )
+                  + (plate_shape - 1) / 2.0
+                  - (block - 1) / 2.0
+                 ) / block
+        warped_image = np.empty(tuple(output_shape) + (channels,))
+        for channel in range(channels):
+            ndi.affine_transform(blocks[..., channel],
+                                 matrix,
+                                 offset=offset,
+                                 output_shape=tuple(output_shape),
+                                 output=warped_image[..., channel],
+                                 order=order,
+                                 mode='constant',
+                                 cval=0.0,
+                                )
+        np.clip(warped_image,
+                min(0.0, blocks.min()),
+                blocks.max(),
+                out=warped_image,
+               )
+        if image.ndim == 2:
+            warped_image = warped_image[..., 0]
+        self.image_stash[tag_out] = warped_image
+        self.feature_stash[feature_out] = rotation
+        return self.image_stash[tag_out], self.feature_stash[feature_out]
+
+    @profiled_stage
+    @stage_outputs(image_params=('tag_out',))
     def crop_border(self,
                     tag_in,
                     tag_out='cropped_image',
@@ -212,6 +987,10 @@ class Plate(object):
                              (right_width, right_height))
         return extended_line
 
+    @profiled_stage
+    @stage_outputs(image_params=('tag_out',),
+                   feature_params=('feature_out',),
+                  )
     def baseline_orient(self,
                         tag_in,
                         tag_out='baseline_oriented_image',
@@ -223,13 +1002,14 @@ class Plate(object):
         image_height = self.image_stash[tag_in]
         if min(y1, y2) < abs(max(y1, y2) - image_height):
             reoriented_image = np.fliplr(np.flipud(self.image_stash[tag_in]))
-            self.image_stash[tag_out] = reoriented_image
+            self.image_stash[tag_out] = Plate.read_only(reoriented_image)
             reoriented_baseline = ((x1, image_height - y2),
                                    (x2, image_height - y1))
             self.feature_stash[feature_out] = reoriented_baseline
         else:
             #No need to reorient
-            self.image_stash[tag_out] = self.image_stash[tag_in].copy()
+            self.image_stash[tag_out] = Plate.read_only(
+                                                    self.image_stash[tag_in])
             self.feature_stash[feature_out] = baseline
         return self.image_stash[tag_out], self.feature_stash[feature_out]
 
@@ -270,7 +1050,7 @@ class Plate(object):
         if basins is None:
             ax.imshow(image_shown)
         else:
-            g_img = rgb2gray(image_shown)
+            g_img = self.stash_view(tag_in)
             if draw_boundaries:
                 boundaries = find_boundaries(basins, mode='inner')
                 bg_img = g_img * ~boundaries
@@ -417,15 +1197,15 @@ class Plate(object):
         return lower_H, upper_H
 
     @staticmethod
-    def rp_intensity(rp,
-                     background,
-                     background_basins=None,
-                     radius=None,
-                     radius_factor=None,
-                     negative=False,
-                     multiplier=1,
-                    ):
-        min_row, min_col, max_row, max_col = rp.bbox
+    def background_window(bbox,
+                          radius=None,
+                          radius_factor=None,
+                         ):
+        """
+        (h, w) slice pair of the background sampled around a regionprops
+        style bbox by Plate.local_background_median.
+        """
+        min_row, min_col, max_row, max_col = bbox
         if radius is None:
             radius = int(np.ceil((sqrt(2) - 1) *
                                  max(abs(max_row - min_row),
@@ -437,24 +1217,117 @@ class Plate(object):
         subimage_maxh = max_row + radius
         subimage_minw = max(0, min_col - radius)
         subimage_maxw = max_col + radius
-        subimage = background[subimage_minh:subimage_maxh,
-                              subimage_minw:subimage_maxw]
+        return (slice(subimage_minh, subimage_maxh),
+                slice(subimage_minw, subimage_maxw),
+               )
+
+    @staticmethod
+    def local_background_median(bbox,
+                                background,
+                                background_basins=None,
+                                radius=None,
+                                radius_factor=None,
+                               ):
+        window = Plate.background_window(bbox=bbox,
+                                         radius=radius,
+                                         radius_factor=radius_factor,
+                                        )
+        subimage = background[window]
         if background_basins is None:
             median_correction = np.median(subimage)
         else:
-            subimage_basins =  background_basins[subimage_minh:subimage_maxh,
-                                                 subimage_minw:subimage_maxw]
-            filtered_subimage = subimage[np.where(subimage_basins == 0)]
+            subimage_basins =  background_basins[window]
+            filtered_subimage = subimage[subimage_basins == 0]
             if len(filtered_subimage) == 0:
                 median_correction = np.median(subimage)
             else:
                 median_correction = np.median(filtered_subimage)
+        return median_correction
+
+    @staticmethod
+    def rp_intensity(rp,
+                     background,
+                     background_basins=None,
+                     radius=None,
+                     radius_factor=None,
+                     negative=False,
+                     multiplier=1,
+                    ):
+        median_correction = Plate.local_background_median(
+                                          bbox=rp.bbox,
+                                          background=background,
+                                          background_basins=background_basins,
+                                          radius=radius,
+                                          radius_factor=radius_factor,
+                                                         )
         intensity = (rp.mean_intensity - median_correction) * rp.area
         if negative:
             intensity *= -1
         intensity *= multiplier
         return intensity
 
+    @staticmethod
+    def label_intensities(basins,
+                          intensity_image,
+                          background,
+                          background_basins=None,
+                          radius=None,
+                          radius_factor=None,
+                          negative=False,
+                          multiplier=1,
+                          labels=None,
+                         ):
+        """
+        Plate.rp_intensity for every nonzero label at once. Label sums and
+        areas come from a single bincount pass and bounding boxes from
+        ndi.find_objects, so only the local background medians are taken
+        per label.
+
+        labels: only measure these labels; their sums and areas are then
+                taken within each label's bounding box.
+
+        Returns ({label: intensity}, {label: area}).
+        """
+        if labels is None:
+            flat_basins = basins.reshape(-1)
+            label_areas = np.bincount(flat_basins)
+            label_sums = np.bincount(flat_basins,
+                                     weights=intensity_image.reshape(-1),
+                                    )
+        intensities, areas = {}, {}
+        for L, label_slice in enumerate(ndi.find_objects(basins), start=1):
+            if label_slice is None:
+                continue
+            if labels is not None:
+                if L not in labels:
+                    continue
+                #Raster order within the box matches the full-image bincount
+                label_mask = (basins[label_slice] == L).reshape(-1)
+                label_areas = {L: np.count_nonzero(label_mask)}
+                label_sums = {L: np.bincount(
+                            label_mask,
+                            weights=intensity_image[label_slice].reshape(-1),
+                            minlength=2,
+                                            )[1]}
+            h_slice, w_slice = label_slice
+            median_correction = Plate.local_background_median(
+                                          bbox=(h_slice.start, w_slice.start,
+                                                h_slice.stop, w_slice.stop),
+                                          background=background,
+                                          background_basins=background_basins,
+                                          radius=radius,
+                                          radius_factor=radius_factor,
+                                                             )
+            area = int(label_areas[L])
+            mean_intensity = label_sums[L] / area
+            intensity = (mean_intensity - median_correction) * area
+            if negative:
+                intensity *= -1
+            intensity *= multiplier
+            intensities[L] = intensity
+            areas[L] = area
+        return intensities, areas
+
     @staticmethod
     def pairwise(iterable):
         """
@@ -480,21 +1353,165 @@ class Plate(object):
         next(b, None)
         return zip(a, b)
 
+    @staticmethod
+    def compact_label_dtype(max_label, dtype=np.uint16):
+        """
+        dtype if it can hold labels up to max_label, otherwise the first of
+        the wider label dtypes (uint32, int64) that can.
+        """
+        dtype = np.dtype(dtype)
+        candidates = [dtype] + [np.dtype(wider) for wider in (np.uint32,
+                                                              np.int64,
+                                                             )
+                                if np.dtype(wider).itemsize > dtype.itemsize]
+        for candidate in candidates:
+            if max_label <= np.iinfo(candidate).max:
+                return candidate
+        return np.dtype(np.int64)
+
+    @staticmethod
+    def compact_labels(basins, dtype=np.uint16):
+        """
+        basins cast to compact_label_dtype of its largest label, without a
+        copy if it already has that dtype.
+        """
+        max_label = int(np.amax(basins)) if basins.size else 0
+        return basins.astype(Plate.compact_label_dtype(max_label, dtype),
+                             copy=False,
+                            )
+
+    def stash_labels(self,
+                     feature_out,
+                     basins,
+                    ):
+        """Store a label image in feature_stash as self.label_dtype."""
+        if self.label_dtype is not None:
+            basins = Plate.compact_labels(basins, dtype=self.label_dtype)
+        self.feature_stash[feature_out] = basins
+
+    def update_basins(self,
+                      basins_feature,
+                      basins,
+                      changed_bbox=None,
+                     ):
+        """
+        Store an edited label image, recording which labels it changed (see
+        record_label_changes).
+        """
+        previous_basins = self.feature_stash.get(basins_feature)
+        self.stash_labels(feature_out=basins_feature,
+                          basins=basins,
+                         )
+        self.record_label_changes(basins_feature=basins_feature,
+                                  previous_basins=previous_basins,
+                                  changed_bbox=changed_bbox,
+                                 )
+
+    def record_label_changes(self,
+                             basins_feature,
+                             previous_basins,
+                             changed_bbox=None,
+                            ):
+        """
+        Add the labels that differ between previous_basins and the current
+        basins_feature, and the bounding box of the differing pixels, to the
+        changes pending since pop_label_changes was last called. If
+        previous_basins is not the label image those changes were tracked up
+        to, the pending changes become unknown.
+
+        changed_bbox: (h, w) slice pair known to contain every changed pixel,
+                      so only it is compared.
+        """
+        changes = self.label_changes.get(basins_feature)
+        if changes is None:
+            return
+        basins = self.feature_stash[basins_feature]
+        if (changes['basins'] is None
+            or changes['basins'] is not previous_basins
+            or previous_basins.shape != basins.shape
+           ):
+            changes['basins'] = None
+            return
+        if changed_bbox is None:
+            changed_bbox = slice(0, basins.shape[0]), slice(0, basins.shape[1])
+        previous_window = previous_basins[changed_bbox]
+        window = basins[changed_bbox]
+        changed_pixels = previous_window != window
+        changed_labels = (set(np.unique(previous_window[changed_pixels]))
+                          | set(np.unique(window[changed_pixels])))
+        changed_labels.discard(0)
+        changes['labels'] |= set(int(L) for L in changed_labels)
+        changed_slices = ndi.find_objects(changed_pixels.astype(np.uint8))
+        if changed_slices:
+            h_slice, w_slice = [slice(local_slice.start + window_slice.start,
+                                      local_slice.stop + window_slice.start)
+                                for local_slice, window_slice
+                                in zip(changed_slices[0], changed_bbox)]
+            if changes['bbox'] is not None:
+                old_h_slice, old_w_slice = changes['bbox']
+                h_slice = slice(min(h_slice.start, old_h_slice.start),
+                                max(h_slice.stop, old_h_slice.stop))
+                w_slice = slice(min(w_slice.start, old_w_slice.start),
+                                max(w_slice.stop, old_w_slice.stop))
+            changes['bbox'] = h_slice, w_slice
+        changes['basins'] = basins
+
+    def pop_label_changes(self, basins_feature):
+        """
+        Labels changed, and the bounding box of changed pixels, since the last
+        call for basins_feature; (None, None) on the first call or if the
+        label image was replaced without being recorded. Tracking restarts
+        from the current label image.
+        """
+        changes = self.label_changes.get(basins_feature)
+        basins = self.feature_stash[basins_feature]
+        self.label_changes[basins_feature] = {'basins': basins,
+                                              'labels': set(),
+                                              'bbox': None,
+                                             }
+        if changes is None or changes['basins'] is not basins:
+            return None, None
+        return changes['labels'], changes['bbox']
+
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out',))
     def find_basin_centroids(self,
                              tag_in,
                              basins_feature='basins',
                              feature_out='basin_centroids',
+                             changed_labels=None,
                             ):
-        intensity_image = rgb2gray(self.image_stash[tag_in])
+        """
+        changed_labels: if given, and feature_out is already in the stash,
+                        only these labels' centroids are recomputed.
+        """
         basins = self.feature_stash[basins_feature]
-        RP = regionprops(label_image=basins,
-                         intensity_image=intensity_image,
-                         coordinates='xy',
-                        )
-        basin_centroids = {rp.label: rp.centroid for rp in RP}
+        if changed_labels is not None and feature_out in self.feature_stash:
+            basin_centroids = {
+                            Label: centroid
+                            for Label, centroid
+                            in self.feature_stash[feature_out].items()
+                            if Label not in changed_labels}
+            changed_basins = np.where(np.isin(basins, list(changed_labels)),
+                                      basins,
+                                      0,
+                                     )
+            RP = regionprops(label_image=changed_basins,
+                             coordinates='xy',
+                            )
+            basin_centroids.update({rp.label: rp.centroid for rp in RP})
+        else:
+            intensity_image = self.stash_view(tag_in)
+            RP = regionprops(label_image=basins,
+                             intensity_image=intensity_image,
+                             coordinates='xy',
+                            )
+            basin_centroids = {rp.label: rp.centroid for rp in RP}
         self.feature_stash[feature_out] = basin_centroids
         return None, self.feature_stash[feature_out]
 
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out',))
     def measure_basin_intensities(self,
                                   tag_in,
                                   median_radius=None,
@@ -503,34 +1520,68 @@ class Plate(object):
                                   basins_feature='basins',
                                   feature_out='basin_intensities',
                                   multiplier=1,
+                                  changed_labels=None,
+                                  changed_bbox=None,
                                  ):
-        g_img = rgb2gray(self.image_stash[tag_in])
+        """
+        changed_labels: if given, and feature_out is already in the stash,
+                        only these labels are remeasured, along with (when
+                        filter_basins is set) those whose background window
+                        overlaps changed_bbox, the bounding box of the edited
+                        pixels.
+        """
+        g_img = self.stash_view(tag_in)
         if median_radius is not None:
             mg_img = median(g_img, selem=disk(median_radius))
         else:
             mg_img = g_img
         basins = self.feature_stash[basins_feature]
-        RP = regionprops(label_image=basins,
-                         intensity_image=g_img,
-                         coordinates='xy',
-                        )
         if filter_basins:
             background_basins = basins
         else:
             background_basins = None
-        basin_intensities = {rp.label:
-                             int(round(Plate.rp_intensity(
-                                           rp=rp,
-                                           background=mg_img,
-                                           background_basins=background_basins,
-                                           radius=None,
-                                           radius_factor=radius_factor,
-                                           negative=True,
-                                           multiplier=multiplier,
-                                                         )
-                                      )
-                                )
-                             for rp in RP}
+        incremental = (changed_labels is not None
+                       and feature_out in self.feature_stash)
+        if incremental:
+            remeasured_labels = set(changed_labels)
+            if background_basins is not None and changed_bbox is not None:
+                for L, label_slice in enumerate(ndi.find_objects(basins),
+                                                start=1,
+                                               ):
+                    if label_slice is None:
+                        continue
+                    h_slice, w_slice = label_slice
+                    window = Plate.background_window(
+                                          bbox=(h_slice.start, w_slice.start,
+                                                h_slice.stop, w_slice.stop),
+                                          radius_factor=radius_factor,
+                                                    )
+                    if all(window_slice.start < changed_slice.stop
+                           and changed_slice.start < window_slice.stop
+                           for window_slice, changed_slice
+                           in zip(window, changed_bbox)):
+                        remeasured_labels.add(L)
+        else:
+            remeasured_labels = None
+        intensities, areas = Plate.label_intensities(
+                                          basins=basins,
+                                          intensity_image=g_img,
+                                          background=mg_img,
+                                          background_basins=background_basins,
+                                          radius=None,
+                                          radius_factor=radius_factor,
+                                          negative=True,
+                                          multiplier=multiplier,
+                                          labels=remeasured_labels,
+                                                    )
+        basin_intensities = {Label: int(round(intensity))
+                             for Label, intensity in intensities.items()}
+        if incremental:
+            previous_intensities = self.feature_stash[feature_out]
+            basin_intensities.update({
+                            Label: intensity
+                            for Label, intensity in previous_intensities.items()
+                            if Label not in remeasured_labels})
         #TODO: Subtract notch intensities from blobs near baseline.
         self.feature_stash[feature_out] = basin_intensities
         return None, self.feature_stash[feature_out]
@@ -551,71 +1602,38 @@ class Plate(object):
                                                )
         return translated_line
 
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out', 'flags_out'))
     def compute_basin_rfs(self,
                           basin_centroids_feature='basin_centroids',
                           baseline_feature='baseline',
                           solvent_front_feature='solvent_front',
                           feature_out='basin_rfs',
+                          flags_out=None,
                          ):
+        """
+        Rfs of all basin centroids, computed together by Plate.rf_array.
+
+        If flags_out is None, a centroid with no well-defined Rf raises an
+        AssertionError as before. Otherwise its Rf is NaN and
+        {label: valid} is stored under flags_out.
+        """
         basin_centroids = self.feature_stash[basin_centroids_feature]
         baseline = self.feature_stash[baseline_feature]
         solvent_front = self.feature_stash[solvent_front_feature]
-        basin_rfs = {}
-        for Label, centroid in basin_centroids.items():
-            distance_to_base = Plate.point_line_distance(point=centroid[::-1],
-                                                         line=baseline,
-                                                        )
-            distance_to_front = Plate.point_line_distance(point=centroid[::-1],
-                                                          line=solvent_front,
-                                                         )
-            base_P1, base_P2 = baseline
-            front_P1, front_P2 = solvent_front
-            cb_1, cb_2 = (centroid[::-1], base_P1), (centroid[::-1], base_P2)
-            cf_1, cf_2 = (centroid[::-1], front_P1), (centroid[::-1], front_P2)
-            intersects_front_1 = Plate.line_segments_intersect(
-                                                       segment_A=cb_1,
-                                                       segment_B=solvent_front,
-                                                              )
-            intersects_front_2 = Plate.line_segments_intersect(
-                                                       segment_A=cb_2,
-                                                       segment_B=solvent_front,
-                                                              )
-            intersects_front = intersects_front_1 or intersects_front_2
-            intersects_base_1 = Plate.line_segments_intersect(
-                                                            segment_A=cf_1,
-                                                            segment_B=baseline,
-                                                             )
-            intersects_base_2 = Plate.line_segments_intersect(
-                                                            segment_A=cf_2,
-                                                            segment_B=baseline,
-                                                             )
-            intersects_base = intersects_base_1 or intersects_base_2
-            assert not (intersects_front and intersects_base)
-            if intersects_front:
-                denominator = distance_to_base - distance_to_front
-                assert denominator > 0, (distance_to_base,
-                                         distance_to_front,
-                                         centroid,
-                                         'intersects_front',
-                                        )
-                rf = distance_to_base / denominator
-            elif intersects_base:
-                denominator = distance_to_front - distance_to_base
-                assert denominator > 0, (distance_to_base,
-                                         distance_to_front,
-                                         centroid,
-                                         'intersects_base',
-                                        )
-                rf = -distance_to_base / denominator
-            else:
-                denominator = distance_to_front + distance_to_base
-                assert denominator > 0, (distance_to_base,
-                                         distance_to_front,
-                                         centroid,
-                                         'neither front nor base',
-                                        )
-                rf = distance_to_base / denominator
-            basin_rfs[Label] = rf
+        labels = list(basin_centroids)
+        points = [basin_centroids[Label][::-1] for Label in labels]
+        rfs, valid = Plate.rf_array(points=points,
+                                    baseline=baseline,
+                                    solvent_front=solvent_front,
+                                   )
+        if flags_out is None:
+            assert np.all(valid), [basin_centroids[Label]
+                                   for Label, v in zip(labels, valid)
+                                   if not v]
+        else:
+            self.feature_stash[flags_out] = dict(zip(labels, valid.tolist()))
+        basin_rfs = dict(zip(labels, rfs.tolist()))
         #baseline_mean = self.baseline_mean(baseline_feature=baseline_feature)
         #if solvent_front == 0 or solvent_front == baseline_mean:
         #    basin_rfs = None
@@ -632,18 +1650,274 @@ class Plate(object):
         self.feature_stash[feature_out] = basin_rfs
         return None, self.feature_stash[feature_out]
 
+    @staticmethod
+    def rf_array(points,
+                 baseline,
+                 solvent_front,
+                ):
+        """
+        points: (N, 2) array of (x, y) spot positions
+        baseline, solvent_front: ((x1, y1), (x2, y2))
+
+        Returns (rfs, valid). A spot is invalid, with an Rf of NaN, when its
+        segments to the line endpoints cross both the baseline and the
+        solvent front, or when the Rf denominator is not positive.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        distance_to_base = Plate.point_line_distances(points=points,
+                                                      line=baseline,
+                                                     )
+        distance_to_front = Plate.point_line_distances(points=points,
+                                                       line=solvent_front,
+                                                      )
+        intersects_front = np.zeros(len(points), dtype=np.bool)
+        for base_P in baseline:
+            intersects_front |= Plate.line_segments_intersect_array(
+                                                       starts=points,
+                                                       ends=base_P,
+                                                       segment_B=solvent_front,
+                                                                   )
+        intersects_base = np.zeros(len(points), dtype=np.bool)
+        for front_P in solvent_front:
+            intersects_base |= Plate.line_segments_intersect_array(
+                                                            starts=points,
+                                                            ends=front_P,
+                                                            segment_B=baseline,
+                                                                  )
+        only_base = intersects_base & ~intersects_front
+        denominators = np.where(intersects_front,
+                                distance_to_base - distance_to_front,
+                                np.where(only_base,
+                                         distance_to_front - distance_to_base,
+                                         distance_to_front + distance_to_base,
+                                        ),
+                               )
+        numerators = np.where(only_base, -distance_to_base, distance_to_base)
+        valid = ~(intersects_front & intersects_base) & (denominators > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rfs = np.where(valid, numerators / denominators, np.nan)
+        return rfs, valid
+
+    @staticmethod
+    def quantize_levels(image):
+        """
+        image quantized to 256 levels spanning its own range, as
+        (levels, image_min, step), or None if image is flat. Reading a level
+        back as image_min + level * step is off by up to half a level,
+        (max - min) / 510.
+        """
+        image_min, image_max = float(np.amin(image)), float(np.amax(image))
+        if image_max == image_min:
+            return None
+        step = (image_max - image_min) / 255
+        levels = np.rint((image - image_min) / step).astype(np.uint8)
+        return levels, image_min, step
+
+    @staticmethod
+    def rank_median(image, radius):
+        """
+        Median over a disk of radius around each pixel of image quantized by
+        Plate.quantize_levels, with skimage.filters.rank, whose cost per pixel
+        grows with the disk's perimeter.
+        """
+        quantized = Plate.quantize_levels(image)
+        if quantized is None:
+            return np.full(image.shape, float(np.amin(image)))
+        levels, image_min, step = quantized
+        return image_min + rank.median(levels, disk(radius)) * step
+
+    @staticmethod
+    def histogram_median(image, radius):
+        """
+        Median over the square of side 2 * radius + 1 around each pixel (cut
+        to the image at its borders; the lower median where the count is
+        even) of image quantized by Plate.quantize_levels, in time per pixel
+        independent of radius, after Perreault and Hebert, "Median Filtering
+        in Constant Time" (2007).
+
+        Each column keeps the histogram of its pixels in the window's rows,
+        updated by one pixel in and one out as the window moves down a row.
+        The window histograms along a row are differences of running sums of
+        the column histograms, taken over 16 coarse levels to find the coarse
+        level holding each median, then over the 16 fine levels within it.
+        """
+        quantized = Plate.quantize_levels(image)
+        if quantized is None:
+            return np.full(image.shape, float(np.amin(image)))
+        levels, image_min, step = quantized
+        height, width = levels.shape
+        columns = np.arange(width)
+        window_starts = np.maximum(columns - radius, 0)
+        window_stops = np.minimum(columns + radius + 1, width)
+        window_widths = window_stops - window_starts
+        fine_histograms = np.zeros((width, 256), dtype=np.int32)
+        coarse_histograms = np.zeros((width, 16), dtype=np.int32)
+        #Running sums over columns, with a leading row of zeros
+        coarse_sums = np.zeros((width + 1, 16), dtype=np.int32)
+        fine_sums = np.zeros((width + 1, 16), dtype=np.int32)
+        median_levels = np.empty((height, width), dtype=np.uint8)
+
+        def update_columns(row, count):
+            fine_histograms[columns, row] += count
+            coarse_histograms[columns, row >> 4] += count
+
+        for h in range(min(radius, height)):
+            update_columns(levels[h], 1)
+        for h in range(height):
+            if h + radius < height:
+                update_columns(levels[h + radius], 1)
+            if h > radius:
+                update_columns(levels[h - radius - 1], -1)
+            window_height = min(h + radius + 1, height) - max(h - radius, 0)
+            median_ranks = (window_height * window_widths + 1) // 2
+            np.cumsum(coarse_histograms, axis=0, out=coarse_sums[1:])
+            window_coarse = (coarse_sums[window_stops]
+                             - coarse_sums[window_starts])
+            coarse_cumulative = np.cumsum(window_coarse, axis=1)
+            coarse_levels = np.argmax(coarse_cumulative
+                                      >= median_ranks[:, np.newaxis],
+                                      axis=1,
+                                     )
+            fine_ranks = (median_ranks
+                          - coarse_cumulative[columns, coarse_levels]
+                          + window_coarse[columns, coarse_levels])
+            for coarse_level in np.unique(coarse_levels):
+                fine_slice = slice(16 * coarse_level, 16 * coarse_level + 16)
+                np.cumsum(fine_histograms[:, fine_slice],
+                          axis=0,
+                          out=fine_sums[1:],
+                         )
+                in_level = np.flatnonzero(coarse_levels == coarse_level)
+                window_fine = (fine_sums[window_stops[in_level]]
+                               - fine_sums[window_starts[in_level]])
+                fine_levels = np.argmax(np.cumsum(window_fine, axis=1)
+                                        >= fine_ranks[in_level, np.newaxis],
+                                        axis=1,
+                                       )
+                median_levels[h, in_level] = 16 * coarse_level + fine_levels
+        return image_min + median_levels * step
+
+    @staticmethod
+    def median_background(image,
+                          median_disk_radius,
+                          method='filter',
+                          downsample=None,
+                         ):
+        """
+        Median of a grayscale image around each pixel, the background
+        median_correct_image divides by.
+        method: 'filter' uses skimage.filters.median over a disk of
+                median_disk_radius. 'histogram' uses Plate.histogram_median,
+                whose cost does not grow with median_disk_radius, over the
+                square of side 2 * median_disk_radius + 1 instead of the
+                disk, so its background is not the same. 'approximate'
+                box-filters the image down by downsample (default
+                median_disk_radius // 8), takes Plate.rank_median there with
+                the radius scaled to match and interpolates it back up. It
+                smooths sharp transitions, such as the plate's edge, that
+                the exact median keeps.
+        """
+        if method == 'filter':
+            return median(image, selem=disk(median_disk_radius))
+        elif method == 'histogram':
+            return Plate.histogram_median(image, median_disk_radius)
+        elif method != 'approximate':
+            raise ValueError("Invalid median method.")
+        if downsample is None:
+            downsample = median_disk_radius // 8
+        if downsample <= 1:
+            return Plate.rank_median(image, median_disk_radius)
+        image_height, image_width = image.shape
+        padded_image = np.pad(image,
+                              ((0, -image_height % downsample),
+                               (0, -image_width % downsample)),
+                              mode='edge',
+                             )
+        small_image = padded_image.reshape(
+                                      padded_image.shape[0] // downsample,
+                                      downsample,
+                                      padded_image.shape[1] // downsample,
+                                      downsample,
+                                          ).mean(axis=(1, 3))
+        small_background = Plate.rank_median(
+                   small_image,
+                   max(1, int(round(float(median_disk_radius) / downsample))),
+                                             )
+        #Block centers sit at (downsample - 1) / 2 in full resolution pixels
+        block_center = (downsample - 1) / 2.0
+        return ndi.affine_transform(small_background,
+                                    [1.0 / downsample, 1.0 / downsample],
+                                    offset=-block_center / downsample,
+                                    output_shape=image.shape,
+                                    order=1,
+                                    mode='nearest',
+                                   )
+
     @staticmethod
     def median_correct_image(image,
                              median_disk_radius,
+                             method='filter',
+                             downsample=None,
+                             background=None,
                             ):
+        """
+        Grayscale image divided by its median background (see
+        median_background for method and downsample), rescaled to keep its
+        mean background level. background, if given, is used as the median
+        background instead of computing it.
+        """
         g_img = rgb2gray(image)
         if median_disk_radius is None or median_disk_radius == 0:
-            mg_img = g_img.copy()
+            mg_img = Plate.read_only(g_img)
         else:
-            m_img = median(g_img, selem=disk(median_disk_radius))
+            if background is None:
+                m_img = Plate.median_background(
+                                         image=g_img,
+                                         median_disk_radius=median_disk_radius,
+                                         method=method,
+                                         downsample=downsample,
+                                               )
+            else:
+                m_img = background
             mg_img = g_img * np.mean(m_img) / m_img
         return mg_img
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(image_params=('tag_out', 'background_out'))
+    def median_correct(self,
+                       tag_in,
+                       tag_out='corrected_image',
+                       median_disk_radius=31,
+                       method='filter',
+                       downsample=None,
+                       background_out=None,
+                      ):
+        """
+        background_out: if given, the median background is also stashed
+                        under this tag, for waterfall_segmentation's
+                        background_tag.
+        """
+        g_img = self.stash_view(tag_in)
+        background = None
+        if background_out is not None and median_disk_radius:
+            background = Plate.median_background(
+                                         image=g_img,
+                                         median_disk_radius=median_disk_radius,
+                                         method=method,
+                                         downsample=downsample,
+                                                )
+            self.image_stash[background_out] = background
+        corrected_image = Plate.median_correct_image(
+                                         image=g_img,
+                                         median_disk_radius=median_disk_radius,
+                                         method=method,
+                                         downsample=downsample,
+                                         background=background,
+                                                    )
+        self.image_stash[tag_out] = corrected_image
+        return self.image_stash[tag_out], None
+
     @staticmethod
     def make_bT_bF(image, dtype=np.bool):
         bT = np.ones_like(image, dtype=dtype)
@@ -673,19 +1947,56 @@ class Plate(object):
         if exclude_label is not None:
             exclude_labels.add(exclude_label)
         open_closed_basins = np.zeros_like(basins)
-        bT, bF = Plate.make_bT_bF(image=basins, dtype=np.bool)
-        for L in np.unique(basins):
-            if L in exclude_labels:
+        image_height, image_width = basins.shape[:2]
+        #Opening then closing cannot reach further than this from a label,
+        #so each label is processed inside its padded bounding box only
+        pad = 2 * open_close_size + 1
+        label_slices = ndi.find_objects(basins)
+        for L, label_slice in enumerate(label_slices, start=1):
+            if label_slice is None or L in exclude_labels:
                 continue
-            label_boolean = np.where(basins == L, bT, bF)
+            h_slice, w_slice = label_slice
+            window = (slice(max(0, h_slice.start - pad),
+                            min(image_height, h_slice.stop + pad)),
+                      slice(max(0, w_slice.start - pad),
+                            min(image_width, w_slice.stop + pad)),
+                     )
+            label_boolean = basins[window] == L
             open_closed = Plate.open_close_boolean_basins(
                                                boolean_basins=label_boolean,
                                                open_close_size=open_close_size,
                                                          )
-            open_closed_basins = np.where(open_closed, L, open_closed_basins)
+            open_closed_basins[window] = np.where(open_closed,
+                                                  L,
+                                                  open_closed_basins[window],
+                                                 )
         open_closed_basins = label(open_closed_basins)
         return open_closed_basins
 
+    @staticmethod
+    def relabel(basins,
+                mapping,
+                keep_unmapped=True,
+               ):
+        """
+        Apply an old -> new label mapping ({label: new_label}; a new label of
+        0 deletes) to every pixel in one pass through a lookup array. Labels
+        missing from mapping are kept if keep_unmapped, else set to 0.
+        """
+        max_label = max([int(np.amax(basins)) if basins.size else 0]
+                        + [int(L) for L in mapping])
+        new_max_label = max([0] + [int(L) for L in mapping.values()])
+        if keep_unmapped:
+            new_max_label = max(new_max_label, max_label)
+        lookup_dtype = Plate.compact_label_dtype(new_max_label, basins.dtype)
+        if keep_unmapped:
+            lookup = np.arange(max_label + 1, dtype=lookup_dtype)
+        else:
+            lookup = np.zeros(max_label + 1, dtype=lookup_dtype)
+        for old_label, new_label in mapping.items():
+            lookup[old_label] = new_label
+        return lookup[basins]
+
     @staticmethod
     def most_frequent_label(basins,
                             image=None,
@@ -702,6 +2013,9 @@ class Plate(object):
                 background_pixel_values,
                )
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(feature_params=('feature_out',))
     def remove_most_frequent_label(self,
                                    basins_feature='basins',
                                    feature_out='filtered_basins',
@@ -712,11 +2026,9 @@ class Plate(object):
          background_pixel_coordinates,
          background_pixel_values,
         ) = Plate.most_frequent_label(basins=basins)
-        empty_basin_template = np.zeros_like(basins)
-        filtered_basins = np.where(basins != most_frequent_label,
-                                   basins,
-                                   empty_basin_template,
-                                  )
+        filtered_basins = Plate.relabel(basins=basins,
+                                        mapping={most_frequent_label: 0},
+                                       )
         filtered_basins = label(filtered_basins)
         #if debug_output:
         #    print("filtered basins debug")
@@ -728,9 +2040,16 @@ class Plate(object):
         #                 figsize=10,
         #                 display_labels=True,
         #                )
-        self.feature_stash[feature_out] = filtered_basins
+        self.stash_labels(feature_out=feature_out,
+                          basins=filtered_basins,
+                         )
         return None, self.feature_stash[feature_out]
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(image_params=('R_out', 'mg_out'),
+                   feature_params=('feature_out',),
+                  )
     def waterfall_segmentation(self,
                                tag_in,
                                feature_out='waterfall_basins',
@@ -742,8 +2061,17 @@ class Plate(object):
                                basin_open_close_size=10,
                                skeleton_label=0,
                                debug_output=False,
+                               median_method='filter',
+                               background_tag=None,
                               ):
         """
+        median_method: algorithm for the median correction (see
+                       Plate.median_background).
+        background_tag: image_stash tag of tag_in's median background at
+                        median_disk_radius, as median_correct stores it with
+                        background_out. The (smoothed) image is corrected by
+                        it instead of by a newly computed median.
+
         Algorithm based on
 
         Beucher, Serge. "Watershed, hierarchical segmentation and waterfall
@@ -758,8 +2086,7 @@ class Plate(object):
             self.display(tag_in='debug_display',
                          figsize=10,
                         )
-        o_img = working_image
-        g_img = rgb2gray(o_img)
+        g_img = self.stash_view(tag_in)
         if smoothing_sigma > 0:
             g_img = gaussian(g_img, sigma=smoothing_sigma)
         if debug_output:
@@ -770,12 +2097,17 @@ class Plate(object):
                         )
         if median_disk_radius is None:
             median_disk_radius = (max(g_img.shape) // 2) * 2 + 1
-            mg_img = g_img.copy()
+            mg_img = g_img
         else:
+            background = (None if background_tag is None
+                          else self.image_stash[background_tag])
             mg_img = \
               Plate.median_correct_image(image=g_img,
-                                         median_disk_radius=median_disk_radius)
-        self.image_stash[mg_out] = mg_img.copy()
+                                         median_disk_radius=median_disk_radius,
+                                         method=median_method,
+                                         background=background,
+                                        )
+        self.image_stash[mg_out] = Plate.read_only(mg_img)
         if debug_output:
             print("median debug")
             self.image_stash['debug_display'] = mg_img
@@ -805,7 +2137,7 @@ class Plate(object):
                         )
         #reconstruction by erosion
         R = reconstruction(g, mg_img, method='erosion')
-        self.image_stash[R_out] = R.copy()
+        self.image_stash[R_out] = Plate.read_only(R)
         if debug_output:
             print("R debug")
             self.image_stash['debug_display'] = R
@@ -852,10 +2184,9 @@ class Plate(object):
             skeleton_labels = np.unique(select_skeleton)
             skeleton_bincount = np.bincount(select_skeleton.reshape(-1))
             skeleton_label = np.argmax(skeleton_bincount[:-1])
-            WR_labels = np.where(WR_labels != skeleton_label,
-                                 WR_labels,
-                                 np.zeros_like(WR_labels),
-                                )
+            WR_labels = Plate.relabel(basins=WR_labels,
+                                      mapping={skeleton_label: 0},
+                                     )
             WR_labels = label(WR_labels)
         if debug_output:
             print("first round WR_labels debug")
@@ -904,7 +2235,9 @@ class Plate(object):
                          figsize=10,
                          display_labels=True,
                         )
-        self.feature_stash[feature_out] = WR_labels
+        self.stash_labels(feature_out=feature_out,
+                          basins=WR_labels,
+                         )
         return None, self.feature_stash[feature_out]
 
     @staticmethod
@@ -914,21 +2247,35 @@ class Plate(object):
                       ):
         if waterfall_labels.shape != watershed_labels.shape:
             raise ValueError((waterfall_labels.shape, watershed_labels.shape))
-        label_mapper = {}
-        label_counter = 1
         overlaid_labels = np.zeros_like(waterfall_labels)
-        for (h, w), waterfall_L in np.ndenumerate(waterfall_labels):
-            if waterfall_L == 0:
-                continue
-            watershed_L = watershed_labels[h, w]
-            if watershed_L == 0:
-                continue
-            if (waterfall_L, watershed_L) not in label_mapper:
-                label_mapper[(waterfall_L, watershed_L)] = label_counter
-                label_counter += 1
-            overlaid_labels[h, w] = label_mapper[(waterfall_L, watershed_L)]
+        overlap = (waterfall_labels != 0) & (watershed_labels != 0)
+        if not np.any(overlap):
+            return overlaid_labels
+        waterfall_L = waterfall_labels[overlap].astype(np.int64)
+        watershed_L = watershed_labels[overlap].astype(np.int64)
+        #Encode each (waterfall_L, watershed_L) pair as a single integer
+        pair_keys = waterfall_L * (int(np.amax(watershed_L)) + 1) + watershed_L
+        unique_keys, first_indices, pair_indices = np.unique(
+                                                           pair_keys,
+                                                           return_index=True,
+                                                           return_inverse=True,
+                                                            )
+        #Number pairs in raster order of first appearance, starting at 1
+        first_seen_order = np.argsort(first_indices)
+        pair_labels = np.empty_like(first_seen_order)
+        pair_labels[first_seen_order] = np.arange(1, len(unique_keys) + 1)
+        overlaid_labels = overlaid_labels.astype(
+                                Plate.compact_label_dtype(len(unique_keys),
+                                                          overlaid_labels.dtype,
+                                                         ),
+                                copy=False,
+                                                )
+        overlaid_labels[overlap] = pair_labels[pair_indices.reshape(-1)]
         return overlaid_labels
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(feature_params=('feature_out',))
     def overlay_watershed(self,
                           tag_in,
                           intensity_image_tag='intensity_image',
@@ -945,7 +2292,7 @@ class Plate(object):
                           debug_output=False,
                           multiplier=1,
                          ):
-        g_img = rgb2gray(self.image_stash[tag_in])
+        g_img = self.stash_view(tag_in)
         if smoothing_sigma > 0:
             g_img = gaussian(g_img, sigma=smoothing_sigma)
         ng_img = np.amax(g_img) - g_img
@@ -976,11 +2323,7 @@ class Plate(object):
                          figsize=10,
                          display_labels=True,
                         )
-        intensity_image = rgb2gray(self.image_stash[intensity_image_tag])
-        RP = regionprops(overlaid_labels,
-                         intensity_image=intensity_image,
-                         coordinates='xy',
-                        )
+        intensity_image = self.stash_view(intensity_image_tag)
         if median_radius is not None:
             median_intensity_image = median(intensity_image,
                                             selem=disk(median_radius),
@@ -993,12 +2336,9 @@ class Plate(object):
             background_basins = overlaid_labels
         else:
             background_basins = None
-        for rp in RP:
-            if min_area is not None and rp.area < min_area:
-                delete_labels.add(rp.label)
-            if min_intensity is not None:
-                intensity = Plate.rp_intensity(
-                                          rp=rp,
+        intensities, areas = Plate.label_intensities(
+                                          basins=overlaid_labels,
+                                          intensity_image=intensity_image,
                                           background=median_intensity_image,
                                           background_basins=background_basins,
                                           radius=None,
@@ -1008,16 +2348,19 @@ class Plate(object):
                                           #          ),
                                           negative=True,
                                           multiplier=multiplier,
-                                              )
+                                                    )
+        for Label, area in areas.items():
+            if min_area is not None and area < min_area:
+                delete_labels.add(Label)
+            if min_intensity is not None:
+                intensity = intensities[Label]
                 if intensity < min_intensity:
                     if debug_output:
                         print(("intensity = " + str(intensity)))
-                    delete_labels.add(rp.label)
-        O, Z = Plate.make_bT_bF(image=overlaid_labels, dtype=np.int)
-        for L in list(delete_labels):
-            mask = np.where(overlaid_labels == L, Z, O)
-            overlaid_labels = np.multiply(overlaid_labels, mask)
-        overlaid_labels = overlaid_labels.astype(np.int)
+                    delete_labels.add(Label)
+        overlaid_labels = Plate.relabel(basins=overlaid_labels,
+                                        mapping={L: 0 for L in delete_labels},
+                                       )
         if debug_output:
             print("filtered overlaid labels debug")
             self.image_stash['debug_display'] = g_img
@@ -1047,7 +2390,9 @@ class Plate(object):
                              figsize=10,
                              display_labels=True,
                             )
-        self.feature_stash[feature_out] = overlaid_labels
+        self.stash_labels(feature_out=feature_out,
+                          basins=overlaid_labels,
+                         )
         return None, self.feature_stash[feature_out]
 
     @staticmethod
@@ -1123,6 +2468,55 @@ class Plate(object):
         numerator_norm = np.linalg.norm(numerator_vector)
         return float(numerator_norm)
 
+    @staticmethod
+    def point_line_distances(points, line):
+        """
+        Plate.point_line_distance for an (N, 2) array of points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        a, b = np.asarray(line, dtype=np.float64)
+        u = (a - b) / np.linalg.norm(a - b)
+        a_p = a - points
+        numerator_vectors = a_p - np.outer(a_p.dot(u), u)
+        return np.linalg.norm(numerator_vectors, axis=1)
+
+    @staticmethod
+    def line_segments_intersect_array(starts,
+                                      ends,
+                                      segment_B,
+                                      error_tolerance=10**-5,
+                                     ):
+        """
+        Plate.line_segments_intersect for the segments (starts[i], ends[i])
+        against segment_B. starts and ends are (N, 2) arrays, or single
+        points that are broadcast.
+        """
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        starts, ends = np.broadcast_arrays(starts.reshape(-1, 2),
+                                           ends.reshape(-1, 2),
+                                          )
+        (xB1, yB1), (xB2, yB2) = np.asarray(segment_B, dtype=np.float64)
+        xA1, yA1 = starts[:, 0], starts[:, 1]
+        xA, yA = ends[:, 0] - xA1, ends[:, 1] - yA1
+        xB, yB = xB2 - xB1, yB2 - yB1
+        denominator = yB * xA - xB * yA
+        numerator_A = xB * (yA1 - yB1) - yB * (xA1 - xB1)
+        numerator_B = xA * (yA1 - yB1) - yA * (xA1 - xB1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            uA, uB = numerator_A / denominator, numerator_B / denominator
+        intersect = (0 <= uA) & (uA <= 1) & (0 <= uB) & (uB <= 1)
+        #parallel segments
+        parallel = denominator == 0
+        if np.any(parallel):
+            line_distances = Plate.point_line_distances(
+                                                       points=starts[parallel],
+                                                       line=segment_B,
+                                                       )
+            intersect[parallel] = line_distances < error_tolerance
+        return intersect
+
+    @profiled_stage
     def subdivide_basin(self,
                         tag_in,
                         feature_out,
@@ -1148,7 +2542,7 @@ class Plate(object):
         W_labels = watershed(grayscale_image,
                              markers=markers,
                             )
-        largest_basins_tag = np.amax(basins)
+        largest_basins_tag = int(np.amax(basins))
         W_labels += largest_basins_tag + 1
         updated_labels = np.where(basins == target_basin,
                                   W_labels,
@@ -1159,43 +2553,122 @@ class Plate(object):
                                False,
                               )
         assert np.amax(basin_check) == False
-        self.feature_stash[feature_out] = updated_labels
+        self.update_basins(basins_feature=feature_out,
+                           basins=updated_labels,
+                          )
+
+    @staticmethod
+    def stamp_label(basins,
+                    label,
+                    coordinates,
+                   ):
+        """
+        Set the pixels at coordinates, (rows, columns) as returned by the
+        skimage.draw functions (e.g. draw.polygon or draw.ellipse with
+        shape=basins.shape), to label in place.
+
+        Returns the (h, w) slice pair bounding the stamped pixels, or None if
+        there are none.
+        """
+        rows, columns = coordinates
+        if len(rows) == 0:
+            return None
+        basins[rows, columns] = label
+        return (slice(int(np.amin(rows)), int(np.amax(rows)) + 1),
+                slice(int(np.amin(columns)), int(np.amax(columns)) + 1),
+               )
+
+    @staticmethod
+    def disk_coordinates(shape,
+                         center,
+                         radius,
+                        ):
+        """
+        (rows, columns) of the pixels of an image of the given shape within
+        radius of center (h, w), boundary included, found within the disk's
+        bounding box only.
+        """
+        center_h, center_w = center
+        min_h = max(0, int(np.ceil(center_h - radius)))
+        max_h = min(shape[0] - 1, int(np.floor(center_h + radius)))
+        min_w = max(0, int(np.ceil(center_w - radius)))
+        max_w = min(shape[1] - 1, int(np.floor(center_w + radius)))
+        h, w = np.meshgrid(np.arange(min_h, max_h + 1),
+                           np.arange(min_w, max_w + 1),
+                           indexing='ij',
+                          )
+        distances = np.sqrt((h - center_h)**2 + (w - center_w)**2)
+        in_disk = distances <= radius
+        return h[in_disk], w[in_disk]
+
+    @staticmethod
+    def half_plane_mask(shape,
+                        line,
+                        window=None,
+                        horizontal_first=False,
+                       ):
+        """
+        Side-of-line test for every pixel of an image of the given shape, or
+        only of window, an (h, w) slice pair. line is ((h1, w1), (h2, w2));
+        pixels are True to the right of a vertical line, below a horizontal
+        line, and otherwise left of the line (w less than the line's w at
+        that row).
+
+        A line through a single point is both vertical and horizontal; it is
+        treated as vertical unless horizontal_first.
+        """
+        (h1, w1), (h2, w2) = line
+        if window is None:
+            window = slice(0, shape[0]), slice(0, shape[1])
+        h_slice, w_slice = window
+        h = np.arange(h_slice.start, h_slice.stop)[:, np.newaxis]
+        w = np.arange(w_slice.start, w_slice.stop)[np.newaxis, :]
+        if w1 == w2 and not (horizontal_first and h1 == h2):
+            side = w > w1
+        elif h1 == h2:
+            side = h > h1
+        else:
+            slope = float(w2 - w1) / (h2 - h1)
+            side = slope * (h - h1) + w1 > w
+        mask = np.empty((len(h), w.shape[1]), dtype=np.bool)
+        mask[...] = side
+        return mask
 
+    @profiled_stage
     def linear_split_basin(self,
                            feature_out,
                            basins_feature,
                            line,
                            target_basin,
                           ):
-        (h1, w1), (h2, w2) = line
         basins = self.feature_stash[basins_feature]
-        split_matrix = np.zeros_like(basins).astype(np.bool)
-        for (h, w), basin in np.ndenumerate(basins):
-            if basin != target_basin:
-                continue
-            elif w1 == w2:
-                if w > w1:
-                    split_matrix[h, w] = True
-            elif h1 == h2:
-                if h > h1:
-                    split_matrix[h, w] = True
-            else:
-                slope = float(w2 - w1) / (h2 - h1)
-                test_w = slope * (h - h1) + w1
-                if test_w > w:
-                    split_matrix[h, w] = True
-        largest_basins_tag = np.amax(basins)
+        split_matrix = np.zeros(basins.shape, dtype=np.bool)
+        basin_slice = ndi.find_objects(basins,
+                                       max_label=target_basin,
+                                      )[target_basin - 1]
+        if basin_slice is not None:
+            split_matrix[basin_slice] = np.logical_and(
+                                        Plate.half_plane_mask(
+                                                          shape=basins.shape,
+                                                          line=line,
+                                                          window=basin_slice,
+                                                             ),
+                                        basins[basin_slice] == target_basin,
+                                                      )
+        largest_basins_tag = int(np.amax(basins))
         new_tag = largest_basins_tag + 1
         largest_mask = np.where(basins == new_tag,
                                 True,
                                 False,
                                )
         assert np.amax(largest_mask) == False
-        updated_basins = np.where(split_matrix,
-                                  new_tag,
-                                  basins,
-                                 )
-        self.feature_stash[feature_out] = updated_basins
+        updated_basins = basins.astype(
+                             Plate.compact_label_dtype(new_tag, basins.dtype),
+                                      )
+        updated_basins[split_matrix] = new_tag
+        self.update_basins(basins_feature=feature_out,
+                           basins=updated_basins,
+                          )
 
     @staticmethod
     def points_colinear(points, error_tolerance=10**-5):
@@ -1231,8 +2704,8 @@ class Plate(object):
     @staticmethod
     def find_largest_distance(points, method="naive"):
         if method == "naive":
-            distances = Plate.all_pairwise_distances(points=points)
-            largest_distance = max(distances.values())
+            distances = pdist(np.asarray(points, dtype=np.float64))
+            largest_distance = np.amax(distances) if len(distances) else 0.0
         elif method == "convex_hull":
             raise NotImplementedError("For small number of points, 'naive' "
                                       "will do.")
@@ -1249,51 +2722,84 @@ class Plate(object):
         return largest_distance
 
     @staticmethod
-    def grid_hough(points):
+    def grid_distance_metrics(points,
+                              angles,
+                              largest_distance,
+                             ):
+        """
+        points: (N, 2) array of (h, w)
+        angles: grid angles in degrees
+
+        For each angle, the sum over points of the distance to the nearest
+        grid line (of that angle or its perpendicular) through any other
+        point, capped at largest_distance.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        thetas = np.deg2rad(np.asarray(angles, dtype=np.float64))
+        cos_t, sin_t = np.cos(thetas)[:, None], np.sin(thetas)[:, None]
+        h, w = points[:, 0], points[:, 1]
+        #Distance to a grid line through another point is the difference of
+        #the two points' projections onto the perpendicular axis
+        along = h * cos_t + w * sin_t
+        across = h * sin_t - w * cos_t
+        distance_metrics = np.empty(len(thetas))
+        for g in range(len(thetas)):
+            along_distances = np.abs(along[g][:, None] - along[g][None, :])
+            across_distances = np.abs(across[g][:, None] - across[g][None, :])
+            grid_distances = np.minimum(along_distances, across_distances)
+            #Avoid comparing point to its own grid archetype
+            np.fill_diagonal(grid_distances, np.inf)
+            if len(points):
+                minimal_distances = np.minimum(grid_distances.min(axis=1),
+                                               largest_distance,
+                                              )
+            else:
+                minimal_distances = grid_distances
+            distance_metrics[g] = np.sum(minimal_distances)
+        return distance_metrics
+
+    @staticmethod
+    def grid_hough(points,
+                   resolution=1,
+                   refinement_factor=10,
+                  ):
         """
         points: [(h1, w1), (h2, w2), (h3, w3), ...]
 
-        Returns optimal grid angle in degrees.
+        Returns optimal grid angle in degrees. Whole degrees are searched
+        first; if resolution < 1 the search is repeated around the best
+        angle with steps refinement_factor times finer until resolution is
+        reached.
         """
-        #Make all unit vectors representing all possible grid angles
-        thetas = np.deg2rad(np.arange(0, 180))
-        sin_cache, cos_cache = np.sin(thetas), np.cos(thetas)
-        unit_vectors = list(zip(cos_cache, sin_cache))
-        perpendicular_unit_vectors = [(unit_vectors[i], unit_vectors[i + 90])
-                                      for i in range(90)]
         #Calculate largest distance between two points
         largest_distance = Plate.find_largest_distance(points=points,
                                                        method='naive')
         #Compute total distance metric for all grid angles
-        distance_metrics = {}
-        for g, grid_archetype in enumerate(perpendicular_unit_vectors):
-            point_grid_archetypes = []
-            for point in points:
-                h, w = point
-                point_grid_archetype = tuple([((h, w),
-                                               (h + unit_vector_h,
-                                                w + unit_vector_w))
-                                              for unit_vector_h, unit_vector_w
-                                              in grid_archetype])
-                point_grid_archetypes.append(point_grid_archetype)
-            total_distances = 0
-            for p, point in enumerate(points):
-                minimal_distance_to_grid = largest_distance
-                for p2, grid_archetype in enumerate(point_grid_archetypes):
-                    if p == p2:
-                        #Avoid comparing point to its own grid archetype
-                        continue
-                    u1, u2 = grid_archetype
-                    u1_distance = Plate.point_line_distance(point=point,
-                                                            line=u1)
-                    u2_distance = Plate.point_line_distance(point=point,
-                                                            line=u2)
-                    min_u_distance = min(u1_distance, u2_distance)
-                    minimal_distance_to_grid = min(minimal_distance_to_grid,
-                                                   min_u_distance)
-                total_distances += minimal_distance_to_grid
-            distance_metrics[g] = total_distances
-        optimal_angle = min(distance_metrics, key=distance_metrics.get)
+        angles = np.arange(0, 90)
+        distance_metrics = Plate.grid_distance_metrics(
+                                             points=points,
+                                             angles=angles,
+                                             largest_distance=largest_distance,
+                                                      )
+        optimal_angle = int(angles[np.argmin(distance_metrics)])
+        step = 1.0
+        decimals = 0
+        while step > resolution:
+            previous_step = step
+            step = max(step / refinement_factor, resolution)
+            #Decimal places needed to write every angle searched so far
+            while round(step, decimals) != step and decimals < 12:
+                decimals += 1
+            num_steps = int(np.ceil(previous_step / step))
+            angles = optimal_angle + np.arange(-num_steps, num_steps + 1) * step
+            distance_metrics = Plate.grid_distance_metrics(
+                                             points=points,
+                                             angles=angles,
+                                             largest_distance=largest_distance,
+                                                          )
+            optimal_angle = float(angles[np.argmin(distance_metrics)] % 90)
+            #Strip the float noise the step arithmetic and % 90 leave behind
+            optimal_angle = round(optimal_angle, decimals) % 90
         return optimal_angle
 
     @staticmethod
@@ -1533,27 +3039,17 @@ class Plate(object):
         x, y = X / norm, Y / norm
         return np.dstack((x, y, Y))
 
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out',))
     def basin_colors(self,
                      tag_in,
                      basins_feature='basins',
                      feature_out='basin_colors',
                      color_space='lab',
                     ):
-        rgb_image = self.image_stash[tag_in]
-        if color_space == 'rgb':
-            color_image = rgb_image
-        elif color_space == 'lab':
-            color_image = rgb2lab(rgb_image)
-        elif color_space == 'hsv':
-            color_image = rgb2hsv(rgb_image)
-        elif color_space == 'XYZ':
-            color_image = rgb2xyz(rgb_image)
-        elif color_space == 'xyY':
-            color_image = Plate.XYZ2xyY(rgb2xyz(rgb_image))
-        elif color_space == 'luv':
-            color_image = rgb2luv(rgb_image)
-        else:
+        if color_space == 'gray':
             raise ValueError("Invalid color space.")
+        color_image = self.stash_view(tag_in, color_space)
         basins = self.feature_stash[basins_feature]
         basin_pixels = defaultdict(list)
         for (h, w), Label in np.ndenumerate(basins):
@@ -1584,6 +3080,7 @@ class Plate(object):
             cluster_distance = np.sum(distances)
         return cluster_distance
 
+    @stage_outputs(feature_params=('feature_out',))
     def mutual_color_distances(self,
                                basin_colors_feature='basin_colors',
                                feature_out='mutual_color_distances',
@@ -1625,6 +3122,9 @@ class Plate(object):
         self.feature_stash[feature_out] = mutual_distances
         return None, self.feature_stash[feature_out]
 
+    @profiled_stage
+    @cached_stage
+    @stage_outputs(image_params=('tag_out',))
     def rescale_image(self,
                       tag_in,
                       tag_out,
@@ -1716,43 +3216,151 @@ class Plate(object):
         np = segment.interpolate(segment.project(point))
         return np.x, np.y
 
+    @staticmethod
+    def make_local_circle(image,
+                          h, w,
+                          radius,
+                         ):
+        """
+        Compact form of make_boolean_circle: returns (circle_slices,
+        circle_mask), where circle_slices is the (h, w) slice pair of the
+        circle's bounding box clipped to the image and circle_mask is the
+        boolean circle inside that box.
+        """
+        h, w, radius = int(round(h)), int(round(w)), int(round(radius))
+        image_height, image_width = image.shape[:2]
+        min_h = min(max(0, h - radius), image_height)
+        max_h = max(min_h, min(image_height, h + radius + 1))
+        min_w = min(max(0, w - radius), image_width)
+        max_w = max(min_w, min(image_width, w + radius + 1))
+        hh, ww = np.ogrid[min_h:max_h, min_w:max_w]
+        circle_mask = ((hh - h)**2 + (ww - w)**2 <= radius**2)
+        circle_slices = slice(min_h, max_h), slice(min_w, max_w)
+        return circle_slices, circle_mask
+
+    @staticmethod
+    def circle_window_mask(circle,
+                           window,
+                          ):
+        """
+        Boolean mask of a make_local_circle circle over window, an (h, w)
+        slice pair with explicit starts and stops.
+        """
+        (circle_h, circle_w), circle_mask = circle
+        window_h, window_w = window
+        window_mask = np.zeros((window_h.stop - window_h.start,
+                                window_w.stop - window_w.start),
+                               dtype=np.bool,
+                              )
+        min_h = max(circle_h.start, window_h.start)
+        max_h = min(circle_h.stop, window_h.stop)
+        min_w = max(circle_w.start, window_w.start)
+        max_w = min(circle_w.stop, window_w.stop)
+        if min_h < max_h and min_w < max_w:
+            window_mask[min_h - window_h.start:max_h - window_h.start,
+                        min_w - window_w.start:max_w - window_w.start] = \
+                     circle_mask[min_h - circle_h.start:max_h - circle_h.start,
+                                 min_w - circle_w.start:max_w - circle_w.start]
+        return window_mask
+
+    @staticmethod
+    def clip_label_to_circle(basins,
+                             basin,
+                             circle,
+                             basin_slice=None,
+                            ):
+        """
+        Set the pixels of basin lying outside a make_local_circle circle to
+        0, in place. basin_slice, e.g. from ndi.find_objects, limits the
+        work to the basin's bounding box.
+        """
+        if basin_slice is None:
+            image_height, image_width = basins.shape[:2]
+            basin_slice = slice(0, image_height), slice(0, image_width)
+        basin_window = basins[basin_slice]
+        inside = Plate.circle_window_mask(circle=circle, window=basin_slice)
+        basin_window[(basin_window == basin) & ~inside] = 0
+        return basins
+
     @staticmethod
     def make_boolean_circle(image,
                             h, w,
                             radius,
                            ):
-        h, w, radius = int(round(h)), int(round(w)), int(round(radius))
-        image_height, image_width = image.shape[:2]
-        hh, ww = np.mgrid[:image_height,:image_width]
-        radial_distance_sq = (hh - h)**2 + (ww - w)**2
-        boolean_circle_array = (radial_distance_sq <= radius**2)
+        circle_slices, circle_mask = Plate.make_local_circle(image=image,
+                                                             h=h, w=w,
+                                                             radius=radius,
+                                                            )
+        boolean_circle_array = np.zeros(image.shape[:2], dtype=np.bool)
+        boolean_circle_array[circle_slices] = circle_mask
         return boolean_circle_array
 
+    @staticmethod
+    def disk_mean_image(image,
+                        radius,
+                       ):
+        """
+        Mean of a grayscale image under a disk centred on every pixel. The
+        disk is the one make_boolean_circle draws for the same radius,
+        clipped at the image edges, and the mean is over the pixels left.
+        """
+        radius = int(round(radius))
+        kernel = disk(radius).astype(np.float64)
+        disk_sums = fftconvolve(image, kernel, mode='same')
+        disk_areas = fftconvolve(np.ones(image.shape[:2]), kernel, mode='same')
+        disk_means = disk_sums / np.rint(disk_areas)
+        return disk_means
+
+    def disk_means(self,
+                   tag_in,
+                   radius,
+                  ):
+        """
+        Plate.disk_mean_image of a stashed image, computed once per radius
+        and recomputed only if the stash entry is replaced.
+        """
+        radius = int(round(radius))
+        image = self.image_stash[tag_in]
+        cached_image, disk_means = self.disk_mean_cache.get((tag_in, radius),
+                                                            (None, None),
+                                                           )
+        if cached_image is not image:
+            disk_means = Plate.disk_mean_image(image=image, radius=radius)
+            self.disk_mean_cache[(tag_in, radius)] = (image, disk_means)
+        return disk_means
+
     @staticmethod
     def best_circle(image,
                     basins,
                     basin,
                     radius,
+                    disk_means=None,
                    ):
-        best_h, best_w, best_circle, best_value = None, None, None, None
-        for (h, w), b in np.ndenumerate(basins):
-            if b != basin:
-                continue
-            boolean_circle = Plate.make_boolean_circle(image=image,
-                                                       h=h, w=w,
-                                                       radius=radius,
-                                                      )
-            circle_sum = np.sum(np.where(boolean_circle, image, 0))
-            circle_area = np.sum(np.where(boolean_circle, 1, 0))
-            #If raw intensity used, circles partially out of bounds score best
-            circle_value = circle_sum / float(circle_area)
-            if best_value is None or circle_value < best_value:
-                best_h = h
-                best_w = w
-                best_circle = boolean_circle
-                best_value = circle_value
+        """
+        Find the pixel of basin whose surrounding circle has the lowest mean
+        intensity. disk_means is Plate.disk_mean_image(image, radius) and is
+        computed here if not supplied. The circle is returned in
+        make_local_circle form.
+        """
+        basin_h, basin_w = np.nonzero(basins == basin)
+        if len(basin_h) == 0:
+            return None, None, None, None
+        if disk_means is None:
+            disk_means = Plate.disk_mean_image(image=image, radius=radius)
+        #If raw intensity used, circles partially out of bounds score best
+        basin_means = disk_means[basin_h, basin_w]
+        #argmin keeps the first pixel in raster order on ties
+        best_index = np.argmin(basin_means)
+        best_h, best_w = int(basin_h[best_index]), int(basin_w[best_index])
+        best_value = float(basin_means[best_index])
+        best_circle = Plate.make_local_circle(image=image,
+                                              h=best_h, w=best_w,
+                                              radius=radius,
+                                             )
         return best_h, best_w, best_circle, best_value
 
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out',))
     def find_blobs(self,
                    tag_in,
                    feature_out='blobs_log',
@@ -1774,3 +3382,159 @@ class Plate(object):
                             )
         self.feature_stash[feature_out] = blobs_log
         return None, self.feature_stash[feature_out]
+
+    @staticmethod
+    def blob_window(basin_slice,
+                    shape,
+                    max_sigma,
+                   ):
+        """
+        basin_slice widened by twice the reach of the largest LoG kernel
+        (clipped to shape). blob_log on a basin isolated within this window
+        finds the same blobs as on the full-frame isolated image.
+        """
+        kernel_reach = int(4.0 * max_sigma + 0.5) + 1
+        window_margin = 2 * kernel_reach
+        return tuple([slice(max(0, s.start - window_margin),
+                            min(size, s.stop + window_margin))
+                      for s, size in zip(basin_slice, shape)])
+
+    @staticmethod
+    def isolated_window_blobs(image,
+                              basins,
+                              basin,
+                              window,
+                              background,
+                              min_sigma=1,
+                              max_sigma=50,
+                              num_sigma=10,
+                              threshold=0.2,
+                              overlap=0.5,
+                              log_scale=False,
+                             ):
+        """
+        blob_log on basin, isolated against background, within window of
+        image. Returns [(h, w, sigma), ...] in full-frame coordinates.
+        """
+        isolated_image = np.where(basins[window] == basin,
+                                  image[window],
+                                  background,
+                                 )
+        blobs = blob_log(image=isolated_image,
+                         min_sigma=min_sigma,
+                         max_sigma=max_sigma,
+                         num_sigma=num_sigma,
+                         threshold=threshold,
+                         overlap=overlap,
+                         log_scale=log_scale,
+                        )
+        h_offset, w_offset = window[0].start, window[1].start
+        return [(h + h_offset, w + w_offset, sigma) for h, w, sigma in blobs]
+
+    @staticmethod
+    def find_window_blobs(image,
+                          basins,
+                          background,
+                          windows,
+                          blob_params,
+                         ):
+        """
+        Default blob_finder for Plate.find_basin_blobs: runs
+        isolated_window_blobs for each basin in windows, in this process.
+        """
+        for basin, window in windows.items():
+            yield basin, Plate.isolated_window_blobs(image=image,
+                                                     basins=basins,
+                                                     basin=basin,
+                                                     window=window,
+                                                     background=background,
+                                                     **blob_params
+                                                    )
+
+    @profiled_stage
+    @stage_outputs(feature_params=('feature_out',))
+    def find_basin_blobs(self,
+                         tag_in,
+                         basins_feature='basins',
+                         feature_out='basin_blobs',
+                         min_sigma=1,
+                         max_sigma=50,
+                         num_sigma=10,
+                         threshold=0.2,
+                         overlap=0.5,
+                         log_scale=False,
+                         labels=None,
+                         blob_finder=None,
+                        ):
+        """
+        blob_log blobs for each basin isolated against the image minimum, as
+        {basin: [(h, w, sigma), ...]}; basins without blobs are left out.
+        Each basin's LoG is computed on a window around its bounding box (see
+        Plate.blob_window) rather than the full frame, and its blobs are
+        cached until the stash entry is replaced or the basin's pixels within
+        the window change, so only edited basins are recomputed across calls.
+
+        labels: only find blobs for these basins.
+        blob_finder: callable(image, basins, background, windows, blob_params)
+                     yielding (basin, blobs) for each basin in windows, e.g.
+                     to spread the basins over worker processes. Defaults to
+                     Plate.find_window_blobs.
+        """
+        if blob_finder is None:
+            blob_finder = Plate.find_window_blobs
+        image = self.image_stash[tag_in]
+        basins = self.feature_stash[basins_feature]
+        blob_params = {'min_sigma': min_sigma,
+                       'max_sigma': max_sigma,
+                       'num_sigma': num_sigma,
+                       'threshold': threshold,
+                       'overlap': overlap,
+                       'log_scale': log_scale,
+                      }
+        key_prefix = (tag_in, min_sigma, max_sigma, num_sigma, threshold,
+                      overlap, log_scale)
+        if labels is not None:
+            labels = set(labels)
+        basin_blobs, windows, masks = {}, {}, {}
+        for basin, basin_slice in enumerate(ndi.find_objects(basins),
+                                            start=1,
+                                           ):
+            if basin_slice is None or (labels is not None
+                                       and basin not in labels):
+                continue
+            window = Plate.blob_window(basin_slice=basin_slice,
+                                       shape=basins.shape,
+                                       max_sigma=max_sigma,
+                                      )
+            mask = basins[window] == basin
+            cached_image, cached = self.basin_blob_cache.get(
+                                                    key_prefix + (basin,),
+                                                    (None, None),
+                                                            )
+            if (cached_image is image
+                and cached[0] == window
+                and np.array_equal(cached[1], mask)
+               ):
+                basin_blobs[basin] = cached[2]
+            else:
+                windows[basin], masks[basin] = window, mask
+        if windows:
+            background = np.amin(image)
+            for basin, blobs in blob_finder(image=image,
+                                            basins=basins,
+                                            background=background,
+                                            windows=windows,
+                                            blob_params=blob_params,
+                                           ):
+                blobs = [tuple(blob) for blob in blobs]
+                self.basin_blob_cache[key_prefix + (basin,)] = (
+                                        image,
+                                        (windows[basin], masks[basin], blobs),
+                                                               )
+                basin_blobs[basin] = blobs
+        self.feature_stash[feature_out] = {basin: blobs
+                                           for basin, blobs
+                                           in sorted(basin_blobs.items())
+                                           if blobs
+                                          }
+        return None, self.feature_stash[feature_out]